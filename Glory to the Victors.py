@@ -4,19 +4,43 @@ import random
 import math
 import pygame
 import json
+import argparse
+import multiprocessing
+import time
+import threading
+import struct
+import hashlib
+import base64
+import zlib
+import gzip
+import sys
+import tempfile
+import weakref
+import platform
+import statistics
+import timeit
+import xml.etree.ElementTree as ElementTree
+from array import array
+from collections import OrderedDict, deque
+from glob import glob
 from os import listdir
 from os.path import isfile, join
 
+# numpy is optional, it is only needed for the batched entity physics
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-# initialize pygame
-pygame.init()
-
-# set the title of the window
-pygame.display.set_caption("Platformer")
 
 # initialize constants for the game
 WIDTH, HEIGHT = 1000, 800  # screen size
-FPS = 60  # frames per second
+LOW_RES_SCALE = 0.5  # size of the world render with --low-res, the pixel art's own size (the assets are loaded at 2x)
+FPS = 60  # physics ticks per second
+TICK_TIME = 1 / FPS  # length of one physics tick in seconds
+MAX_FPS = 144  # cap on frames drawn per second while playing (0 for no cap)
+MAX_CATCH_UP_STEPS = 5  # most physics ticks run in one frame when the game falls behind
+PREFETCH_BUDGET = 0.003  # seconds of a frame the prefetcher can spend building the next level
 PLAYER_VEL = 5  # player velocity
 PLAYER_WIDTH = 50 # player width
 PLAYER_HEIGHT = 50 # player height
@@ -31,6 +55,34 @@ GAME = 1 #index for playing game state
 GAME_OVER = 2 #index for game over game state
 GAME_WIN = 3 #index for win game state
 FALL_THRESHOLD = 715  # value where the player takes damage
+SWEEP_STEP = BLOCK_SIZE // 2  # longest move checked for collisions at once, faster moves are split into sub-steps
+TERRAIN_TILE = 3  # id of the block tile in the terrain tileset (Tiled ids start at 1)
+LEVEL_BUILD_DIR = join("levels", "build")  # where compiled levels are written
+ATLAS_BUILD_DIR = join("assets", "build")  # where the packed texture atlas is saved, so later starts load it as is
+ATLAS_PAGE_SIZE = 1024  # width and height of a texture atlas page
+ATLAS_VERSION = 1  # bumped when the way the atlas is packed changes, so old saved atlases are packed again
+REWIND_INTERVAL = 6  # ticks between the states kept for rewinding
+REWIND_SECONDS = 10  # how far back the game can be rewound
+CAMERA_MODES = ("follow", "group", "split")  # follow player one, zoom out to keep every player in view, or a view per player (F2 switches)
+ZOOM_LEVELS = (1, 0.75, 0.5)  # zooms the group camera can use, chunks and blocks are a whole number of pixels at each
+ZOOM_IN_ROOM = 1.2  # how much room the players need before the group camera zooms back in, so it doesn't flicker between zooms
+CAMERA_MARGIN = 150  # space the group camera keeps around the players
+SPLIT_LINE_WIDTH = 4  # width of the lines between split screen views
+PROFILE_TRACE_PATH = "profile_trace.json"  # where the profiler saves its trace (F4 or when quitting)
+BENCHMARK_BLOCKS = (1000, 10000, 100000)  # sizes of the generated stress levels
+BENCHMARK_PLAYERS = (1, 2, 3, 4)  # player counts every level is benchmarked with
+BENCHMARK_ENTITIES = (1000, 10000)  # entity counts the batched entity physics is benchmarked with (needs numpy)
+BENCHMARK_HAZARDS = (100, 500)  # hazard counts the hazard pool is benchmarked with
+BENCHMARK_TICKS = 120  # ticks played before timing, so the players are somewhere in the level
+BENCHMARK_REPEATS = 9  # single calls timed for the slow metrics (level loading, atlas packing), the median is kept
+BENCHMARK_ROUNDS = 7  # rounds every time is measured in, the best is kept
+BENCHMARK_ROUND_SECONDS = 0.05  # shortest round, fast calls are repeated until a round takes this long
+BENCHMARK_TOLERANCE = 0.25  # how much slower than the baseline a result can be before it counts as a regression
+BENCHMARK_MIN_DELTA = {"_us": 1.0, "_ms": 0.5}  # smallest slowdown (in the metric's unit) that counts as a regression, anything less is timer noise
+STREAMING_MIN_TILES = 20000  # levels with more tiles than this are streamed in chunks instead of loaded all at once
+STREAMING_CHUNK_TILES = 8  # width and height of a streamed chunk in tiles
+STREAMING_RADIUS = 1  # chunks kept loaded around the camera and each player
+STREAMING_MAX_BYTES = 64 * 1024 * 1024  # memory budget for the surfaces of loaded chunks
 
 # list of player key bindings dictionaries
 PLAYER_BINDINGS = [
@@ -45,17 +97,313 @@ PLAYER_BINDINGS = [
 ]
 
 
-# create a window with set width and height
-window = pygame.display.set_mode((WIDTH, HEIGHT))
-
-
-# function to flip a list of sprites horizontally
-def flip(sprites):
-    return [pygame.transform.flip(sprite, True, False) for sprite in sprites]
+# characters for each player (sprite folder, sprite width, sprite height)
+#MAKE SURE DIMENSIONS ARE ACCURATE WITH SPRITE SHEET
+CHARACTERS = [
+    ("p1Njal", 12, 45),
+    ("p2Revna", 15, 42),
+    ("p3Dwalin", 13, 35),
+    ("p4Bjorn", 10, 43),
+]
 
 
-# function to load sprite sheets from a dir
-def load_sprite_sheets(character_folder, character_name, width, height, direction=False):
+# function to initialize pygame and create a window with set width and height
+def create_window():
+    pygame.init()
+    # set the title of the window
+    pygame.display.set_caption("Platformer")
+    # the window can be resized, the game is drawn at its own size and scaled to fit
+    return pygame.display.set_mode((WIDTH, HEIGHT), pygame.RESIZABLE)
+
+
+# function to initialize pygame without a real window, for running the physics on its own
+def init_headless(size=(1, 1)):
+    # the dummy video driver never opens a window
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    # only the display is needed (starting every module, like audio, can hang in worker processes)
+    pygame.display.init()
+    # a tiny display is still needed so images can be converted when levels load
+    return pygame.display.set_mode(size)
+
+
+# function to cut a rect out of an image and scale it up (2x uses scale2x, like every sprite of the game)
+def cut_image(image, rect=None, scale=1):
+    if rect is not None:
+        # blit the sub rect of the sheet onto its own surface
+        surface = pygame.Surface((rect[2], rect[3]), pygame.SRCALPHA, 32)
+        surface.blit(image, (0, 0), rect)
+        image = surface
+    if scale == 2:
+        return pygame.transform.scale2x(image)
+    if scale != 1:
+        return pygame.transform.scale(image, (image.get_width() * scale, image.get_height() * scale))
+    return image
+
+
+# class that keeps loaded and converted images in memory so each one is only built once
+class AssetCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes  # memory budget before the oldest assets get evicted
+        self.assets = OrderedDict()  # cached assets, least recently used first
+        self.sizes = {}  # approximate size in bytes of each cached asset
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    # method to get an asset by key, building it with the given function on a miss
+    def get(self, key, build):
+        asset = self.assets.get(key)
+        if asset is not None:
+            self.hits += 1
+            self.assets.move_to_end(key)
+            return asset
+
+        self.misses += 1
+        asset = build()
+        self.assets[key] = asset
+        self.sizes[key] = asset_size(asset)
+        self.total_bytes += self.sizes[key]
+
+        # evict the least recently used assets until we are back under budget
+        while self.total_bytes > self.max_bytes and len(self.assets) > 1:
+            old_key, _ = self.assets.popitem(last=False)
+            self.total_bytes -= self.sizes.pop(old_key)
+        return asset
+
+    # method to load an image, optionally cut out of a sheet, scaled and flipped
+    def load_image(self, path, rect=None, scale=1, flip=False):
+        if rect is not None:
+            rect = tuple(rect)
+        key = (path, rect, scale, flip)
+
+        def build():
+            # whole files are only decoded and converted once
+            if rect is None and scale == 1 and not flip:
+                return pygame.image.load(path).convert_alpha()
+            # flipped images are built from the cached unflipped one
+            if flip:
+                image = pygame.transform.flip(self.load_image(path, rect, scale), True, False)
+            else:
+                image = cut_image(self.load_image(path), rect, scale)
+            if scale == 2:
+                # zoomed() draws 2x images from the native art at low resolution
+                native_sources[image] = (path, rect, flip)
+            return image
+
+        return self.get(key, build)
+
+    # method to get the cache counters, useful for checking the cache is doing its job
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "assets": len(self.assets),
+            "bytes": self.total_bytes,
+        }
+
+    # method to empty the cache
+    def clear(self):
+        self.assets.clear()
+        self.sizes.clear()
+        self.total_bytes = 0
+
+
+# function to estimate how much memory a cached asset uses
+def asset_size(asset):
+    if isinstance(asset, pygame.Surface):
+        return asset.get_width() * asset.get_height() * asset.get_bytesize()
+    if isinstance(asset, pygame.mask.Mask):
+        width, height = asset.get_size()
+        return width * height // 8
+    if isinstance(asset, (list, tuple)):
+        return sum(asset_size(item) for item in asset)
+    return 0
+
+
+# shared cache used by everything that loads images
+asset_cache = AssetCache()
+
+
+# function to make a copy of a surface scaled to a camera zoom
+def scale_surface(surface, zoom):
+    size = (max(1, round(surface.get_width() * zoom)), max(1, round(surface.get_height() * zoom)))
+    if (1 / zoom).is_integer():
+        # shrinking the 2x pixel art by a whole factor keeps its hard pixel edges
+        scaled = pygame.transform.scale(surface, size)
+    else:
+        scaled = pygame.transform.smoothscale(surface, size)
+    # run-length encoded like the surface it was scaled from (the terrain chunks)
+    if surface.get_flags() & pygame.RLEACCELOK:
+        scaled.set_alpha(255, pygame.RLEACCEL)
+    return scaled
+
+
+# scaled copies of the sprites, hazards and backgrounds, surface -> {zoom: copy}
+# the keys are weak, so the copies are freed with the surface they were scaled from instead of keeping it alive
+zoomed_copies = weakref.WeakKeyDictionary()
+
+
+# the art the images loaded at 2x were made from, surface -> (path, rect, flip) to load it at scale 1
+# weak keys like zoomed_copies, so an entry goes away with its image
+native_sources = weakref.WeakKeyDictionary()
+
+
+# function to check if images at a zoom can be made from the native art by repeating or dropping whole pixels
+def native_zoom(zoom):
+    return (0.5 / zoom).is_integer()
+
+
+# function to get a surface scaled to a camera zoom, shared by every view and every frame at that zoom
+# 2x images at half size and below are made from their native art (the low resolution render draws it as is)
+# instead of shrinking the 2x copy, which scale2x may have changed
+# (the terrain chunks keep their own scaled copies, see StaticLayer and WorldChunk)
+def zoomed(surface, zoom):
+    if zoom == 1:
+        return surface
+    copies = zoomed_copies.get(surface)
+    if copies is None:
+        copies = zoomed_copies[surface] = {}
+    scaled = copies.get(zoom)
+    if scaled is None:
+        source = native_sources.get(surface) if native_zoom(zoom) else None
+        if source is None:
+            scaled = scale_surface(surface, zoom)
+        else:
+            path, rect, flip = source
+            native = asset_cache.load_image(path, rect, 1, flip)
+            scaled = native if zoom == 0.5 else scale_surface(native, zoom * 2)
+        copies[zoom] = scaled
+    return scaled
+
+
+# class for a texture atlas, many small images packed into a few big page surfaces
+# images are looked up by the same key as AssetCache.load_image, each one is a subsurface of its page
+# so it can be used like any other surface, and drawn in batches with blits() from its page and area
+class TextureAtlas:
+    def __init__(self, page_size=ATLAS_PAGE_SIZE):
+        self.page_size = page_size
+        self.pages = []  # the big surfaces the images are packed into
+        self.regions = {}  # key -> (page index, rect of the image on the page)
+        self.images = {}  # key -> subsurface of the page
+        self.sources = {}  # subsurface -> (page, rect), what blits() needs to draw it
+
+    # method to forget every page and image
+    def clear(self):
+        self.pages = []
+        self.regions.clear()
+        self.images.clear()
+        self.sources.clear()
+
+    # method to add an image that is already on a page
+    def add_region(self, key, index, rect):
+        image = self.pages[index].subsurface(rect)
+        self.regions[key] = (index, rect)
+        self.images[key] = image
+        self.sources[image] = (self.pages[index], rect)
+
+    # method to pack images (a dict of key -> surface) onto new pages
+    # they are placed in rows from the tallest to the shortest, and a new page is started when one is full
+    # the last page is only as tall as the rows on it
+    def pack(self, images):
+        self.clear()
+        places = []  # (key, image, page index, rect)
+        heights = [0]  # used height of each page
+        x = y = row_height = 0
+        for key, image in sorted(images.items(), key=lambda item: -item[1].get_height()):
+            width, height = image.get_size()
+            if x + width > self.page_size:
+                x, y, row_height = 0, y + row_height, 0
+            if y + height > self.page_size:
+                heights.append(0)
+                x = y = row_height = 0
+            places.append((key, image, len(heights) - 1, pygame.Rect(x, y, width, height)))
+            heights[-1] = max(heights[-1], y + height)
+            x += width
+            row_height = max(row_height, height)
+
+        self.pages = [pygame.Surface((self.page_size, max(1, height)), pygame.SRCALPHA, 32) for height in heights]
+        for key, image, index, rect in places:
+            # the page is empty there, so adding copies the pixels exactly instead of blending them
+            self.pages[index].blit(image, rect, special_flags=pygame.BLEND_RGBA_ADD)
+            self.add_region(key, index, rect)
+
+    # method to get a packed image, or None if it isn't in the atlas
+    def image(self, key):
+        return self.images.get(key)
+
+    # method to get what blits() needs to draw an image: its page and area for atlas images, or the image itself and no area
+    def source(self, image):
+        return self.sources.get(image, (image, None))
+
+    # method to save the pages with an index of the regions
+    # the pages are raw pixels compressed with zlib, which loads about twice as fast as a png
+    # sources are the hashes of the files the images came from, to tell when the saved atlas is out of date
+    def save(self, folder, sources):
+        os.makedirs(folder, exist_ok=True)
+        for index, page in enumerate(self.pages):
+            with open(join(folder, f"atlas{index}.page"), "wb") as f:
+                f.write(zlib.compress(pygame.image.tobytes(page, "RGBA"), 1))
+        index_data = {
+            "version": ATLAS_VERSION,
+            "page_size": self.page_size,
+            "sources": sources,
+            "pages": [page.get_size() for page in self.pages],
+            "regions": [[list(key), index, list(rect)] for key, (index, rect) in self.regions.items()],
+        }
+        with open(join(folder, "atlas.json"), "w") as f:
+            json.dump(index_data, f)
+
+    # method to load an atlas saved with save, returns False if there isn't one or it is out of date
+    def load(self, folder, sources):
+        try:
+            with open(join(folder, "atlas.json"), "r") as f:
+                index_data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if index_data.get("version") != ATLAS_VERSION or index_data.get("sources") != sources:
+            return False
+        pages = []
+        try:
+            for index, size in enumerate(index_data["pages"]):
+                with open(join(folder, f"atlas{index}.page"), "rb") as f:
+                    pages.append(pygame.image.frombytes(zlib.decompress(f.read()), tuple(size), "RGBA").convert_alpha())
+        except (OSError, ValueError, zlib.error):
+            return False  # a page is missing or damaged, pack the atlas again
+        self.clear()
+        self.page_size = index_data["page_size"]
+        self.pages = pages
+        for key, index, rect in index_data["regions"]:
+            # json turns the key tuples into lists
+            key = tuple(tuple(part) if isinstance(part, list) else part for part in key)
+            self.add_region(key, index, pygame.Rect(rect))
+        return True
+
+    def __contains__(self, key):
+        return key in self.images
+
+    def __len__(self):
+        return len(self.images)
+
+
+# shared texture atlas of the character frames and terrain tiles (empty until load_texture_atlas)
+texture_atlas = TextureAtlas()
+
+
+# function to load an image, from the texture atlas if it was packed there (same arguments as AssetCache.load_image)
+def load_sprite(path, rect=None, scale=1, flip=False):
+    image = texture_atlas.image((path, tuple(rect) if rect is not None else None, scale, flip))
+    return image if image is not None else asset_cache.load_image(path, rect, scale, flip)
+
+
+# function to get the collision mask of an image loaded with load_sprite
+def load_sprite_mask(path, rect=None, scale=1, flip=False):
+    if rect is not None:
+        rect = tuple(rect)
+    return asset_cache.get(("mask", path, rect, scale, flip), lambda: pygame.mask.from_surface(load_sprite(path, rect, scale, flip)))
+
+
+# function to load every frame of the sprite sheets in a dir, using load to get each frame
+def load_sheet_frames(character_folder, character_name, width, height, direction, load):
     # get the path to the sprite sheet dir
     path = join("assets", character_folder, character_name)
     # get a list of files in the dir
@@ -66,27 +414,25 @@ def load_sprite_sheets(character_folder, character_name, width, height, directio
 
     # loop through each file in the dir
     for image in images:
-        # load the sprite sheet
-        sprite_sheet = pygame.image.load(join(path, image)).convert_alpha()
-
-        # list to store individual sprites
-        sprites = []
-        # loop through each sprite in the sprite sheet
-        #TODO make the sprite sheets
-        for i in range(sprite_sheet.get_width() // width):
-            # create a surface for the sprite
-            surface = pygame.Surface((width, height), pygame.SRCALPHA, 32)
-            # get the rectangle for sprite
-            rect = pygame.Rect(i * width, 0, width, height)
-            # blit (place image of) the sprite onto the surface
-            surface.blit(sprite_sheet, (0, 0), rect)
-            # scale the sprite up
-            sprites.append(pygame.transform.scale2x(surface))
+        # count the frames in the texture atlas if the sheet was packed there, then the sheet isn't even decoded
+        count = 0
+        while (join(path, image), (count * width, 0, width, height), 2, False) in texture_atlas:
+            count += 1
+        if not count:
+            # get the sprite sheet (decoded once and kept in the asset cache)
+            sprite_sheet = asset_cache.load_image(join(path, image))
+
+            # loop through each sprite in the sprite sheet
+            #TODO make the sprite sheets
+            count = sprite_sheet.get_width() // width
+        # get the rectangle for each sprite, the atlas has it or the cache cuts it out and scales it up
+        rects = [(i * width, 0, width, height) for i in range(count)]
+        sprites = [load(join(path, image), rect, 2) for rect in rects]
 
         # if the sprite sheet has a direction (like left and right), add both directions to the dictionary
         if direction:
             all_sprites[image.replace(".png", "") + "_right"] = sprites
-            all_sprites[image.replace(".png", "") + "_left"] = flip(sprites)
+            all_sprites[image.replace(".png", "") + "_left"] = [load(join(path, image), rect, 2, True) for rect in rects]
         # else, add the sprite sheet to dictionary
         else:
             all_sprites[image.replace(".png", "")] = sprites
@@ -95,36 +441,136 @@ def load_sprite_sheets(character_folder, character_name, width, height, directio
     return all_sprites
 
 
+# function to load sprite sheets from a dir
+def load_sprite_sheets(character_folder, character_name, width, height, direction=False):
+    return load_sheet_frames(character_folder, character_name, width, height, direction, load_sprite)
+
+
+# function to load the collision masks for every frame of the sprite sheets in a dir
+# (same layout as load_sprite_sheets, so masks are looked up by sheet, direction and index)
+def load_sprite_masks(character_folder, character_name, width, height, direction=False):
+    return load_sheet_frames(character_folder, character_name, width, height, direction, load_sprite_mask)
+
+
 # function to get a block sprite
 def get_block(size):
+    # the block of the normal size is packed in the texture atlas
+    block = texture_atlas.image(("block", size))
+    if block is not None:
+        return block
+
     # get the path to the block sprite
     path = join("assets", "Terrain", "Terrain.png")
-    # load the block sprite
-    image = pygame.image.load(path).convert_alpha()
-    # create surface for block
-    surface = pygame.Surface((size, size), pygame.SRCALPHA, 32)
-    # get the rectangle for the block
-    rect = pygame.Rect(96, 0, size, size)
-    # blit the block onto the surface
-    surface.blit(image, (0, 0), rect)
-    # scale block ip by a factor of 2
-    return pygame.transform.scale2x(surface)
+
+    def build():
+        # get the block scaled up by a factor of 2
+        scaled = asset_cache.load_image(path, (96, 0, size, size), 2)
+        # create surface for block and blit the top left of the scaled block onto it
+        surface = pygame.Surface((size, size), pygame.SRCALPHA, 32)
+        surface.blit(scaled, (0, 0))
+        native_sources[surface] = block_native_source(size)
+        return surface
+
+    # every block of the same size shares this one surface
+    return asset_cache.get(("block", size), build)
+
+
+# function to get the native art of the block sprite of a size, as (path, rect, flip) like native_sources
+# the block is the top left of the 2x sprite, so it is the top left quarter of the same rect at scale 1
+def block_native_source(size):
+    return join("assets", "Terrain", "Terrain.png"), (96, 0, size // 2, size // 2), False
+
+
+# function to get the files the texture atlas is made from: every character sprite sheet and the terrain tileset
+def atlas_source_files():
+    paths = []
+    for character_name, _, _ in CHARACTERS:
+        path = join("assets", "MainCharacters", character_name)
+        paths += sorted(join(path, f) for f in listdir(path) if isfile(join(path, f)))
+    return paths + [DEFAULT_TILESET.image]
+
+
+# function to cut out every image that goes in the texture atlas
+# each frame of each character in both directions, the block and the other terrain tiles at the game size
+def atlas_images():
+    images = {}
+    for character_name, width, height in CHARACTERS:
+        path = join("assets", "MainCharacters", character_name)
+        for sheet_path in sorted(join(path, f) for f in listdir(path) if isfile(join(path, f))):
+            # cut from the sheet directly, so the separate frames aren't kept in the asset cache as well
+            sheet = asset_cache.load_image(sheet_path)
+            for i in range(sheet.get_width() // width):
+                rect = (i * width, 0, width, height)
+                frame = cut_image(sheet, rect, 2)
+                images[(sheet_path, rect, 2, False)] = frame
+                images[(sheet_path, rect, 2, True)] = pygame.transform.flip(frame, True, False)
+
+    tileset = DEFAULT_TILESET
+    scale = BLOCK_SIZE // tileset.tile_width
+    sheet = asset_cache.load_image(tileset.image)
+    for tile in range(tileset.first_gid, tileset.first_gid + tileset.columns * (sheet.get_height() // tileset.tile_height)):
+        if tile - tileset.first_gid + 1 == TERRAIN_TILE:
+            continue  # drawn with the block sprite (see get_tile)
+        images[(tileset.image, tileset.rect(tile), scale, False)] = cut_image(sheet, tileset.rect(tile), scale)
+    images[("block", BLOCK_SIZE)] = get_block(BLOCK_SIZE)
+    return images
+
+
+# function to fill the shared texture atlas, loading it from folder if it was saved there and is up to date
+# otherwise it is packed from the sprite sheets and saved to folder (nothing is saved if folder is None)
+def load_texture_atlas(folder=ATLAS_BUILD_DIR):
+    sources = {path: file_hash(path).hex() for path in atlas_source_files()}
+    if folder is None or not texture_atlas.load(folder, sources):
+        texture_atlas.pack(atlas_images())
+        if folder is not None:
+            texture_atlas.save(folder, sources)
+    # the packed 2x images are drawn from their native art at low resolution, like the ones from the asset cache
+    for key in texture_atlas.regions:
+        if key[0] == "block":
+            native_sources[texture_atlas.image(key)] = block_native_source(key[1])
+        elif key[2] == 2:
+            native_sources[texture_atlas.image(key)] = (key[0], key[1], key[3])
+    return texture_atlas
+
+
+# function to get the sprite of a hazard (a row of spikes), shared by every hazard of the same size
+def get_hazard_image(width, height):
+    def build():
+        surface = pygame.Surface((width, height), pygame.SRCALPHA, 32)
+        spikes = max(1, width // (height or 1))
+        spike_width = width / spikes
+        for i in range(spikes):
+            left = i * spike_width
+            pygame.draw.polygon(surface, (200, 30, 30), [(left, height - 1), (left + spike_width / 2, 0), (left + spike_width - 1, height - 1)])
+        return surface
+
+    return asset_cache.get(("hazard", width, height), build)
+
+
+# function to get the collision mask of a hazard, shared like its sprite
+def get_hazard_mask(width, height):
+    return asset_cache.get(("hazard_mask", width, height), lambda: pygame.mask.from_surface(get_hazard_image(width, height)))
 
 
 # object class
 class Object(pygame.sprite.Sprite):
     # initialize the object
-    def __init__(self, x, y, width, height, name=None):
+    def __init__(self, x, y, width, height, name=None, image=None):
         super().__init__()
         self.rect = pygame.Rect(x, y, width, height)
-        self.image = pygame.Surface((width, height), pygame.SRCALPHA)
+        # use the given image (shared between objects) or make a blank one
+        self.image = image if image is not None else pygame.Surface((width, height), pygame.SRCALPHA)
         self.width = width
         self.height = height
         self.name = name
 
+    # method to get what blits() needs to draw the object, zoom is the scale of the camera view
+    def blit_item(self, offset_x, offset_y, zoom=1):
+        return zoomed(self.image, zoom), (round((self.rect.x - offset_x) * zoom), round((self.rect.y - offset_y) * zoom))
+
     # method to draw the object
-    def draw(self, win, offset_x, offset_y):
-        win.blit(self.image, (self.rect.x - offset_x, self.rect.y - offset_y))
+    def draw(self, win, offset_x, offset_y, zoom=1):
+        win.blit(*self.blit_item(offset_x, offset_y, zoom))
 
 
 # exit class
@@ -136,28 +582,587 @@ class Exit(Object):
         self.mask = pygame.mask.from_surface(self.image)
 
 
-# class for blocks
-class Block(Object):
-    # method to initialize the block
-    def __init__(self, x, y, size):
-        # initialize the block
-        super().__init__(x, y, size, size)
-        # get the block sprite
-        block = get_block(size)
-        # blit the block onto the image
-        self.image.blit(block, (0, 0))
-        # update the mask
-        self.mask = pygame.mask.from_surface(self.image)
+# class for the static blocks of a level, stored as parallel arrays instead of one sprite per block
+# every block of a size shares the same image (get_block), so a block is just its x, y, size and tile id
+# Object (a full sprite) is only used for things that move or change, like the exit
+class BlockArray:
+    def __init__(self, block_data=()):
+        self.xs = array("i")
+        self.ys = array("i")
+        self.sizes = array("H")
+        self.tiles = array("H")
+        for x, y, size, tile in block_data:
+            self.append(x, y, size, tile)
+
+    # method to add a block
+    def append(self, x, y, size, tile=TERRAIN_TILE):
+        self.xs.append(x)
+        self.ys.append(y)
+        self.sizes.append(size)
+        self.tiles.append(tile)
+
+    # method to get the rect of a block, rects are only made when they are needed
+    def rect(self, index):
+        size = self.sizes[index]
+        return pygame.Rect(self.xs[index], self.ys[index], size, size)
+
+    # method to get the rect around every block, or None if there are no blocks
+    def bounds(self):
+        if not self.xs:
+            return None
+        left = min(self.xs)
+        top = min(self.ys)
+        right = max(x + size for x, size in zip(self.xs, self.sizes))
+        bottom = max(y + size for y, size in zip(self.ys, self.sizes))
+        return pygame.Rect(left, top, right - left, bottom - top)
+
+    # the blocks can be looped over as (x, y, size, tile), like the block data they were made from
+    def __iter__(self):
+        return zip(self.xs, self.ys, self.sizes, self.tiles)
+
+    def __len__(self):
+        return len(self.xs)
+
+
+# class for a hazard (spikes, saws, projectiles...) that hurts the players when they touch it
+# hazards are kept in a HazardPool and reused, so spawning one doesn't make new objects
+class Hazard(Object):
+    def __init__(self):
+        super().__init__(0, 0, 0, 0, "hazard", image=get_hazard_image(1, 1))
+        self.mask = get_hazard_mask(1, 1)
+        self.x_vel = 0
+        self.y_vel = 0
+        self.distance = 0  # how far it goes before turning back (0 to keep going)
+        self.travelled = 0  # how far it went since it last turned back
+        self.lifetime = None  # ticks left before it is removed (None to stay forever)
+
+    # method to set up the hazard when it is spawned
+    def reset(self, x, y, width, height, x_vel=0, y_vel=0, distance=0, lifetime=None):
+        self.rect.update(x, y, width, height)
+        self.image = get_hazard_image(width, height)
+        self.mask = get_hazard_mask(width, height)
+        self.x_vel = round(x_vel)
+        self.y_vel = round(y_vel)
+        self.distance = distance
+        self.travelled = 0
+        self.lifetime = lifetime
+
+    # method to get the state of the hazard as a tuple (see restore)
+    def snapshot(self):
+        return (*self.rect, self.x_vel, self.y_vel, self.distance, self.travelled, self.lifetime, self.image, self.mask)
+
+    # method to put the hazard back in a state from snapshot
+    def restore(self, state):
+        x, y, width, height, self.x_vel, self.y_vel, self.distance, self.travelled, self.lifetime, self.image, self.mask = state
+        self.rect.update(x, y, width, height)
+
+    # method to move the hazard one tick, returns False when it should be removed
+    def update(self):
+        if self.x_vel or self.y_vel:
+            self.rect.move_ip(self.x_vel, self.y_vel)
+            if self.distance:
+                self.travelled += max(abs(self.x_vel), abs(self.y_vel))
+                # go back the other way at the end of its path
+                if self.travelled >= self.distance:
+                    self.x_vel = -self.x_vel
+                    self.y_vel = -self.y_vel
+                    self.travelled = 0
+        if self.lifetime is not None:
+            self.lifetime -= 1
+            return self.lifetime > 0
+        return True
+
+
+# class that keeps the hazards of a level, reusing removed hazards for new ones
+# the rects of the active hazards are kept in one list so each player is checked against all of them in one call
+class HazardPool:
+    def __init__(self, capacity=256):
+        self.free = [Hazard() for _ in range(capacity)]  # made up front so spawning doesn't make objects
+        self.active = []  # hazards in play
+        self.rects = []  # rects of the active hazards, in the same order (the hazards move them in place)
+
+    # method to spawn a hazard, a new one is only made if every hazard in the pool is in use
+    def spawn(self, x, y, width, height, x_vel=0, y_vel=0, distance=0, lifetime=None):
+        hazard = self.free.pop() if self.free else Hazard()
+        hazard.reset(x, y, width, height, x_vel, y_vel, distance, lifetime)
+        self.active.append(hazard)
+        self.rects.append(hazard.rect)
+        return hazard
+
+    # method to remove the active hazard at an index, the last one takes its place
+    def despawn(self, index):
+        hazard = self.active[index]
+        self.active[index] = self.active[-1]
+        self.rects[index] = self.rects[-1]
+        self.active.pop()
+        self.rects.pop()
+        self.free.append(hazard)
+
+    # method to remove every hazard and spawn the ones of a level, given as (x, y, width, height, x_vel, y_vel, distance)
+    def load(self, hazard_data):
+        while self.active:
+            self.despawn(len(self.active) - 1)
+        for hazard in hazard_data:
+            self.spawn(*hazard)
+
+    # method to get the state of every active hazard
+    def snapshot(self):
+        return tuple(hazard.snapshot() for hazard in self.active)
+
+    # method to put the hazards back in a state from snapshot
+    def restore(self, states):
+        while self.active:
+            self.despawn(len(self.active) - 1)
+        for state in states:
+            hazard = self.free.pop() if self.free else Hazard()
+            hazard.restore(state)
+            self.active.append(hazard)
+            self.rects.append(hazard.rect)
+
+    # method to move every hazard one tick and remove the ones that ran out of time
+    def update(self):
+        for index in range(len(self.active) - 1, -1, -1):
+            if not self.active[index].update():
+                self.despawn(index)
+
+    # method to get the players touching a hazard
+    def hits(self, players):
+        hit_players = []
+        for player in players:
+            # rects first (one call for every hazard), then masks only for the few rects that overlap
+            for index in player.rect.collidelistall(self.rects):
+                if pygame.sprite.collide_mask(player, self.active[index]):
+                    hit_players.append(player)
+                    break
+        return hit_players
+
+    # method to hurt the players touching a hazard, now is the time in milliseconds
+    # a player can only be hurt once a second, and at most one life is lost per tick however many players are hit
+    def resolve_damage(self, players, lives, now):
+        hit_this_frame = False  # Flag to track if any player was hit this frame
+        for player in self.hits(players):
+            if now - player.last_hit_time > 1000:  # prevent players from taking infinite damage
+                player.make_hit(now)
+                hit_this_frame = True
+        if hit_this_frame:  # Decrease lives only if a player has been hit in this frame
+            lives -= 1
+        return lives
+
+    # method to draw the hazards inside the camera view
+    def draw(self, win, offset_x, offset_y, zoom=1):
+        view_width, view_height = win.get_size()
+        view = pygame.Rect(offset_x, offset_y, math.ceil(view_width / zoom), math.ceil(view_height / zoom))
+        win.blits([self.active[index].blit_item(offset_x, offset_y, zoom) for index in view.collidelistall(self.rects)], doreturn=False)
+
+    def __len__(self):
+        return len(self.active)
+
+
+# spatial index that buckets static objects into a grid of BLOCK_SIZE cells
+# so collision checks only look at the objects near the player
+class SpatialGrid:
+    def __init__(self, objects, cell_size=BLOCK_SIZE):
+        self.cell_size = cell_size
+        self.objects = []  # every object, in the order they were added
+        self.cells = {}  # (column, row) -> indexes of the objects touching that cell
+        for obj in objects:
+            self.add(obj)
+
+    # method to get the range of cells a rect covers
+    def cell_range(self, rect):
+        size = self.cell_size
+        columns = range(rect.left // size, max(rect.left, rect.right - 1) // size + 1)
+        rows = range(rect.top // size, max(rect.top, rect.bottom - 1) // size + 1)
+        return columns, rows
+
+    # method to add an object to every cell its rect touches
+    def add(self, obj):
+        index = len(self.objects)
+        self.objects.append(obj)
+        columns, rows = self.cell_range(obj.rect)
+        for column in columns:
+            for row in rows:
+                self.cells.setdefault((column, row), []).append(index)
+
+    # method to get the objects overlapping a rect, in the order they were added
+    def query(self, rect):
+        columns, rows = self.cell_range(rect)
+        found = set()
+        for column in columns:
+            for row in rows:
+                found.update(self.cells.get((column, row), ()))
+        candidates = [self.objects[i] for i in sorted(found)]
+        # test all the candidates against the rect in one batched call
+        return [candidates[i] for i in rect.collidelistall(candidates)]
+
+    # the grid can be used like the plain object list (e.g. for drawing)
+    def __iter__(self):
+        return iter(self.objects)
+
+    def __len__(self):
+        return len(self.objects)
+
+
+# function to get the objects near a rect, from a spatial grid (or streaming world) or a plain list of objects
+def query_objects(objects, rect):
+    if hasattr(objects, "query"):
+        return objects.query(rect)
+    objects = list(objects)
+    return [objects[i] for i in rect.collidelistall(objects)]
+
+
+# class for a solid rectangle used only for collisions, made of several merged blocks
+class CollisionSpan:
+    def __init__(self, x, y, width, height, name="block"):
+        self.rect = pygame.Rect(x, y, width, height)  # collisions are swept against the rect, no mask needed
+        self.name = name
+
+
+# function to merge touching blocks (a BlockArray) into as few solid rectangles as possible (greedy meshing)
+# the blocks are still drawn one by one, this is only for collisions
+def merge_blocks(blocks):
+    spans = []
+    # group the blocks by size, only blocks of the same size are merged
+    grids = {}
+    for x, y, size, _ in blocks:
+        grids.setdefault(size, set()).add((x, y))
+
+    for size, cells in grids.items():
+        spans += merge_cells(cells, size)
+    return spans
+
+
+# function to merge the solid tiles of a tile map into collision rectangles
+def merge_tilemap(tilemap):
+    cells = {(x, y) for x, y, _ in tilemap.cells()}
+    return merge_cells(cells, tilemap.tile_size)
+
+
+# function to greedily merge a set of solid cells (top left corners, all the same size) into rectangles
+def merge_cells(cells, size):
+    spans = []
+    # go through the cells top to bottom, left to right
+    for x, y in sorted(cells, key=lambda cell: (cell[1], cell[0])):
+        if (x, y) not in cells:
+            continue  # already part of a span
+        # grow the span to the right as far as possible
+        columns = 1
+        while (x + columns * size, y) in cells:
+            columns += 1
+        # grow the span down while the whole row below is solid
+        rows = 1
+        while all((x + i * size, y + rows * size) in cells for i in range(columns)):
+            rows += 1
+        # remove the covered cells so they are not used again
+        for i in range(columns):
+            for j in range(rows):
+                cells.discard((x + i * size, y + j * size))
+        spans.append(CollisionSpan(x, y, columns * size, rows * size))
+    return spans
+
+
+# function to make an empty chunk surface
+def new_chunk(size):
+    chunk = pygame.Surface((size, size), pygame.SRCALPHA, 32).convert_alpha()
+    # run-length encoded when it is first drawn, so its empty parts cost almost nothing to blit
+    chunk.set_alpha(255, pygame.RLEACCEL)
+    return chunk
+
+
+# function to draw images (a list of (image, (x, y))) onto a chunk at a zoom
+# one blits() call, with the atlas page and area of the images that come from the texture atlas
+def draw_images(chunk, images, zoom=1):
+    batch = []
+    for image, (x, y) in images:
+        source, area = texture_atlas.source(zoomed(image, zoom))
+        batch.append((source, (round(x * zoom), round(y * zoom)), area))
+    chunk.blits(batch, doreturn=False)
+
+
+# function to make a copy of a chunk at a zoom, images is what was drawn on the chunk
+# at the zooms zoomed() takes from the native art the chunk is drawn again from it, otherwise the chunk is scaled
+def zoom_chunk(chunk, images, zoom):
+    if not native_zoom(zoom):
+        return scale_surface(chunk, zoom)
+    scaled = new_chunk(round(chunk.get_width() * zoom))
+    draw_images(scaled, images, zoom)
+    return scaled
+
+
+# class for the level terrain pre-drawn into big chunk surfaces
+# drawing only blits the chunks the camera can see, so it costs the same however big the level is
+class StaticLayer:
+    def __init__(self, chunk_size=512):
+        self.chunk_size = chunk_size
+        self.chunks = {}  # (column, row) -> surface with every image in that chunk drawn on it
+        self.zoomed = {}  # (column, row, zoom) -> scaled copy of a chunk, for zoomed out views
+        self.images = {}  # (column, row) -> every (image, position) drawn on that chunk, to draw it again at a zoom
+        self.pending = {}  # (column, row) -> the (image, position) not drawn onto that chunk yet
+
+    # method to draw every block of a BlockArray onto the chunks
+    def add_blocks(self, blocks):
+        self.add_images([(get_block(size), pygame.Rect(x, y, size, size)) for x, y, size, _ in blocks])
+
+    # method to draw every tile of a tile map onto the chunks
+    def add_tilemap(self, tilemap):
+        tile_size = tilemap.tile_size
+        self.add_images([(get_tile(tile, tilemap.tilesets, tile_size), pygame.Rect(x, y, tile_size, tile_size)) for x, y, tile in tilemap.cells()])
+
+    # method to draw images at rects (a list of (image, rect)) onto the chunks they overlap
+    # the images are queued per chunk and drawn when the chunk is baked, either a few at a time by the
+    # level prefetcher or the first time the chunk is seen, so adding a whole level doesn't take one long frame
+    def add_images(self, images):
+        size = self.chunk_size
+        pending = self.pending
+        drawn = self.images
+        for image, rect in images:
+            for column in range(rect.left // size, (rect.right - 1) // size + 1):
+                for row in range(rect.top // size, (rect.bottom - 1) // size + 1):
+                    placed = (image, (rect.x - column * size, rect.y - row * size))
+                    pending.setdefault((column, row), []).append(placed)
+                    drawn.setdefault((column, row), []).append(placed)
+
+    # method to draw the queued images of a chunk onto it
+    def bake(self, key):
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            chunk = self.chunks[key] = new_chunk(self.chunk_size)
+        draw_images(chunk, self.pending.pop(key))
+        # scaled copies made before this drawing are out of date
+        for zoomed_key in [zoomed_key for zoomed_key in self.zoomed if zoomed_key[:2] == key]:
+            del self.zoomed[zoomed_key]
+        return chunk
+
+    # method to bake one queued chunk, returns False when there is nothing left to bake
+    def bake_next(self):
+        if not self.pending:
+            return False
+        self.bake(next(iter(self.pending)))
+        return True
+
+    # method to draw the chunks that are inside the camera view
+    # zoomed out views use scaled copies of the chunks (shared by every view), placed in scaled pixels so they line up exactly
+    def draw(self, win, offset_x, offset_y, zoom=1):
+        size = round(self.chunk_size * zoom)
+        view_width, view_height = win.get_size()
+        left, top = round(offset_x * zoom), round(offset_y * zoom)
+        for column in range(left // size, (left + view_width - 1) // size + 1):
+            for row in range(top // size, (top + view_height - 1) // size + 1):
+                if (column, row) in self.pending:
+                    self.bake((column, row))
+                chunk = self.chunks.get((column, row))
+                if chunk is not None:
+                    win.blit(self.zoomed_chunk(column, row, zoom), (column * size - left, row * size - top))
+
+    # method to get a chunk scaled to a zoom, the copies belong to the layer so they go away with its level
+    def zoomed_chunk(self, column, row, zoom):
+        if zoom == 1:
+            return self.chunks[(column, row)]
+        scaled = self.zoomed.get((column, row, zoom))
+        if scaled is None:
+            scaled = self.zoomed[(column, row, zoom)] = zoom_chunk(self.chunks[(column, row)], self.images[(column, row)], zoom)
+        return scaled
+
+
+# class for one chunk of a streamed level, with its pre-drawn surface and collision rectangles
+class WorldChunk:
+    def __init__(self, rect, surface, spans, images=()):
+        self.rect = rect  # world rect the chunk covers
+        self.surface = surface  # None if the chunk has no tiles
+        self.images = images  # the (image, position) of the tiles drawn on the surface, to draw it again at a zoom
+        self.spans = spans  # merged collision rectangles of the chunk's tiles
+        self.last_used = 0  # frame the chunk was last needed, for evicting the oldest chunks first
+        self.zoomed = {}  # zoom -> scaled copy of the surface, freed with the chunk
+
+    # method to get how much memory the chunk's surface and its scaled copies use
+    def size(self):
+        return (asset_size(self.surface) if self.surface is not None else 0) + sum(asset_size(copy) for copy in self.zoomed.values())
+
+
+# class for a very large level that only keeps the chunks around the camera and the players loaded
+# chunks are drawn and merged into collision rectangles from the tile map when they are first needed
+# the chunks that leave the radius stay loaded until the memory budget is hit, then the least recently used are freed
+# it can be used for drawing (like StaticLayer) and for collisions (like SpatialGrid)
+class StreamingWorld:
+    def __init__(self, tilemap, chunk_tiles=STREAMING_CHUNK_TILES, radius=STREAMING_RADIUS, max_bytes=STREAMING_MAX_BYTES):
+        self.tilemap = tilemap
+        self.chunk_tiles = chunk_tiles
+        self.chunk_size = chunk_tiles * tilemap.tile_size  # size of a chunk in pixels
+        self.radius = radius
+        self.max_bytes = max_bytes
+        self.chunk_bytes = self.chunk_size * self.chunk_size * 4  # most memory a chunk's surface can use
+        self.chunks = {}  # (column, row) -> loaded WorldChunk
+        self.total_bytes = 0
+        self.frame = 0
+        self.loads = 0  # how many chunks have been loaded, for checking the streaming works
+        self.evictions = 0
+
+    # method to get the range of chunks a rect covers (only chunks inside the map)
+    def chunk_range(self, rect, radius=0):
+        size = self.chunk_size
+        tilemap = self.tilemap
+        columns = (tilemap.columns + self.chunk_tiles - 1) // self.chunk_tiles
+        rows = (tilemap.rows + self.chunk_tiles - 1) // self.chunk_tiles
+        left = max(0, (rect.left - tilemap.origin_x) // size - radius)
+        right = min(columns, (rect.right - 1 - tilemap.origin_x) // size + 1 + radius)
+        top = max(0, (rect.top - tilemap.origin_y) // size - radius)
+        bottom = min(rows, (rect.bottom - 1 - tilemap.origin_y) // size + 1 + radius)
+        return range(left, right), range(top, bottom)
+
+    # method to get a chunk, loading it if needed
+    def chunk(self, column, row):
+        chunk = self.chunks.get((column, row))
+        if chunk is None:
+            chunk = self.load(column, row)
+            self.chunks[(column, row)] = chunk
+            self.total_bytes += chunk.size()
+            self.loads += 1
+        chunk.last_used = self.frame
+        return chunk
+
+    # method to draw a chunk and merge its tiles into collision rectangles
+    def load(self, column, row):
+        tilemap = self.tilemap
+        tile_size = tilemap.tile_size
+        x = tilemap.origin_x + column * self.chunk_size
+        y = tilemap.origin_y + row * self.chunk_size
+        surface = None
+        cells = set()
+        images = []  # tiles to draw, in one blits() call
+        for j in range(row * self.chunk_tiles, min(tilemap.rows, (row + 1) * self.chunk_tiles)):
+            for i in range(column * self.chunk_tiles, min(tilemap.columns, (column + 1) * self.chunk_tiles)):
+                tile = tilemap.get(i, j)
+                if not tile:
+                    continue
+                tile_x = tilemap.origin_x + i * tile_size
+                tile_y = tilemap.origin_y + j * tile_size
+                images.append((get_tile(tile, tilemap.tilesets, tile_size), (tile_x - x, tile_y - y)))
+                cells.add((tile_x, tile_y))
+        if images:
+            surface = new_chunk(self.chunk_size)
+            draw_images(surface, images)
+        return WorldChunk(pygame.Rect(x, y, self.chunk_size, self.chunk_size), surface, merge_cells(cells, tile_size), images)
+
+    # method called every frame with the camera rect and the player rects
+    # loads the chunks around them, nearest first, and keeps the loaded chunks within the memory budget
+    def update(self, rects):
+        self.frame += 1
+        # how far each chunk within the radius is from the camera or the nearest player, in chunks
+        distances = {}
+        for rect in rects:
+            near_columns, near_rows = self.chunk_range(rect)
+            columns, rows = self.chunk_range(rect, self.radius)
+            for column in columns:
+                for row in rows:
+                    distance = max(near_columns.start - column, column - near_columns.stop + 1, near_rows.start - row, row - near_rows.stop + 1, 0)
+                    if distance < distances.get((column, row), math.inf):
+                        distances[(column, row)] = distance
+
+        for key in sorted(distances, key=distances.get):
+            if distances[key] and key not in self.chunks:
+                # make room by freeing chunks farther away, when there is none the radius shrinks for this frame
+                self.trim(distances, distances[key], self.chunk_bytes)
+                if self.total_bytes + self.chunk_bytes > self.max_bytes:
+                    continue
+            self.chunk(*key)
+        self.trim(distances)
+
+    # method to free chunks until the loaded ones fit in the memory budget (with room bytes to spare)
+    # chunks no longer in the radius are kept until the budget is hit, then go least recently used first,
+    # then the chunks in the radius farthest from the camera and players (only those farther than nearest)
+    # the chunks under the camera and players are never freed here, they are needed this frame
+    def trim(self, distances, nearest=0, room=0):
+        max_bytes = self.max_bytes - room
+        if self.total_bytes <= max_bytes:
+            return
+        far = [key for key in self.chunks if distances.get(key, math.inf) > nearest]
+        far.sort(key=lambda key: (distances.get(key, math.inf), -self.chunks[key].last_used))
+        while far and self.total_bytes > max_bytes:
+            self.evict(far.pop())
+
+    # method to free a loaded chunk
+    def evict(self, key):
+        chunk = self.chunks.pop(key)
+        self.total_bytes -= chunk.size()
+        self.evictions += 1
+
+    # method to get the collision rectangles overlapping a rect (loads the chunks it needs)
+    def query(self, rect):
+        columns, rows = self.chunk_range(rect)
+        spans = []
+        for row in rows:
+            for column in columns:
+                spans += self.chunk(column, row).spans
+        return [spans[i] for i in rect.collidelistall(spans)]
+
+    # method to draw the chunks that are inside the camera view
+    def draw(self, win, offset_x, offset_y, zoom=1):
+        view_width, view_height = win.get_size()
+        left, top = round(offset_x * zoom), round(offset_y * zoom)
+        columns, rows = self.chunk_range(pygame.Rect(offset_x, offset_y, math.ceil(view_width / zoom), math.ceil(view_height / zoom)))
+        for column in columns:
+            for row in rows:
+                chunk = self.chunk(column, row)
+                if chunk.surface is not None:
+                    win.blit(self.zoomed_surface(chunk, zoom), (round(chunk.rect.x * zoom) - left, round(chunk.rect.y * zoom) - top))
+
+    # method to get a chunk's surface scaled to a zoom
+    # the copy is kept on the chunk and counted in the memory budget, so it is freed when the chunk is evicted
+    def zoomed_surface(self, chunk, zoom):
+        if zoom == 1:
+            return chunk.surface
+        scaled = chunk.zoomed.get(zoom)
+        if scaled is None:
+            scaled = chunk.zoomed[zoom] = zoom_chunk(chunk.surface, chunk.images, zoom)
+            self.total_bytes += asset_size(scaled)
+        return scaled
 
 
 # level class to handle individual levels
 class level:
-    def __init__(self, name, background, blocks, exit, player_start):
+    def __init__(self, name, background, blocks, exit, player_start, tilemap=None, streaming=False, hazards=()):
         self.name = name
         self.background = background
-        self.blocks = blocks
+        self.blocks = blocks  # BlockArray of the blocks that are not in the tile map
         self.exit = exit
         self.player_start = player_start
+        self.hazards = list(hazards)  # hazards placed in the level, as (x, y, width, height, x_vel, y_vel, distance)
+        self.tilemap = tilemap  # grid of tiles (levels from Tiled maps or compiled levels), or None
+        self.streaming = streaming
+        self._terrain = None
+        if streaming:
+            # the tiles are loaded in chunks around the players as they move
+            self.world = StreamingWorld(tilemap)
+            self.collision = []
+            self.collision_saved = 0
+            self.grid = self.world
+            self._terrain = self.world
+            return
+
+        # touching blocks and tiles merged into bigger rectangles for collisions
+        self.collision = merge_blocks(blocks)
+        tile_count = 0
+        if tilemap is not None:
+            self.collision += merge_tilemap(tilemap)
+            tile_count = tilemap.count()
+        self.collision_saved = len(blocks) + tile_count - len(self.collision)  # how many collision objects merging saved
+        # spatial index of the collision rectangles used by all the collision checks
+        self.grid = SpatialGrid(self.collision)
+
+    # method to stream in the chunks around the camera and the players (only does something for streamed levels)
+    def stream(self, rects):
+        if self.streaming:
+            self.world.update(rects)
+
+    # the blocks pre-drawn into chunks for fast drawing, only made when the level is first drawn
+    @property
+    def terrain(self):
+        if self._terrain is None:
+            self._terrain = StaticLayer()
+            self._terrain.add_blocks(self.blocks)
+            if self.tilemap is not None:
+                self._terrain.add_tilemap(self.tilemap)
+        return self._terrain
 
 # player class
 class Player(pygame.sprite.Sprite):
@@ -179,9 +1184,17 @@ class Player(pygame.sprite.Sprite):
         self.color = (255, 0, 0)
         self.last_hit_time = 0  # keeps track of the last hit
         self.on_ground = False  # Flag to indicate if the player is on the ground
+        self.prev_x, self.prev_y = x, y  # position at the previous physics tick
         self.SPRITES = load_sprite_sheets(
             character_folder, character_name, sprite_width, sprite_height, True
         )
+        # masks for each frame are built once here instead of every update
+        self.MASKS = load_sprite_masks(
+            character_folder, character_name, sprite_width, sprite_height, True
+        )
+        # start with the first idle sprite so the player can be drawn before the first update
+        self.sprite = self.SPRITES["idle_" + self.direction][0]
+        self.mask = self.MASKS["idle_" + self.direction][0]
 
     def jump(self):
         if self.jump_count < 2:
@@ -202,11 +1215,11 @@ class Player(pygame.sprite.Sprite):
         self.rect.x += dx
         self.rect.y += dy
 
-    # method to make the player hit
-    def make_hit(self):
+    # method to make the player hit, now is the time in milliseconds (the real clock if not given)
+    def make_hit(self, now=None):
         # set hit flag to True
         self.hit = True
-        self.last_hit_time = pygame.time.get_ticks()
+        self.last_hit_time = pygame.time.get_ticks() if now is None else now
 
     # method to move the player left
     def move_left(self, vel):
@@ -226,14 +1239,35 @@ class Player(pygame.sprite.Sprite):
             self.direction = "right"
             self.animation_count = 0
 
+    # method to get the state of the player as a tuple (see restore)
+    def snapshot(self):
+        return (
+            self.rect.x, self.rect.y, self.rect.width, self.rect.height, self.x_vel, self.y_vel, self.direction,
+            self.animation_count, self.fall_count, self.jump_count, self.hit, self.hit_count, self.last_hit_time,
+            self.on_ground, self.prev_x, self.prev_y, self.sprite, self.mask,
+        )
+
+    # method to put the player back in a state from snapshot
+    def restore(self, state):
+        (x, y, width, height, self.x_vel, self.y_vel, self.direction,
+         self.animation_count, self.fall_count, self.jump_count, self.hit, self.hit_count, self.last_hit_time,
+         self.on_ground, self.prev_x, self.prev_y, self.sprite, self.mask) = state
+        self.rect.update(x, y, width, height)
+
+    # method to remember the current position as the one at the previous tick
+    def reset_previous_position(self):
+        self.prev_x, self.prev_y = self.rect.x, self.rect.y
+
     # method to update the player
     def loop(self, fps):
+        # remember where the player was at the start of the tick so drawing can blend between ticks
+        self.reset_previous_position()
+
         # check if on ground to apply gravity, call gravity only if not on ground
         if not self.on_ground:
             self.y_vel += min(1, (self.fall_count / fps) * GRAVITY)
 
-        # move the player by the x and y values
-        self.move(self.x_vel, self.y_vel)
+        # the player is moved by move_and_collide in handle_move, so it stops at whatever is in the way
 
         # if player is hit, increment hit counter
         if self.hit:
@@ -248,8 +1282,10 @@ class Player(pygame.sprite.Sprite):
         # update sprite
         self.update_sprite()
 
-    # method to land the player
-    def landed(self):
+    # method to land the player, snapping them onto the top edge of the ground if given
+    def landed(self, top=None):
+        if top is not None:
+            self.rect.bottom = top
         self.fall_count = 0
         self.y_vel = 0
         self.jump_count = 0  # Reset jump count when landed
@@ -284,8 +1320,9 @@ class Player(pygame.sprite.Sprite):
         # Get the sprite index based on the animation counter
         sprite_index = (self.animation_count // ANIMATION_DELAY) % len(sprites)
 
-        # Set the sprite
+        # Set the sprite and its precomputed mask
         self.sprite = sprites[sprite_index]
+        self.mask = self.MASKS[sprite_sheet_name][sprite_index]
         # Increment the animation counter
         self.animation_count += 1
         # Update the player
@@ -297,19 +1334,26 @@ class Player(pygame.sprite.Sprite):
 
     # method to update the player
     def update(self):
-        # update the rectangle and mask
-        self.rect = self.sprite.get_rect(topleft=(self.rect.x, self.rect.y))
-        self.mask = pygame.mask.from_surface(self.sprite)
+        # resize the rectangle to the sprite (the mask is already set by update_sprite)
+        self.rect.size = self.sprite.get_size()
+
+    # method to get what blits() needs to draw the player, alpha blends between the previous tick (0) and the current one (1)
+    # at full size the sprite is drawn from its texture atlas page
+    def blit_item(self, offset_x, offset_y, alpha=1, zoom=1):
+        x = round(self.prev_x + (self.rect.x - self.prev_x) * alpha)
+        y = round(self.prev_y + (self.rect.y - self.prev_y) * alpha)
+        source, area = texture_atlas.source(zoomed(self.sprite, zoom))
+        return source, (round((x - offset_x) * zoom), round((y - offset_y) * zoom)), area
 
     # method to draw the player
-    def draw(self, win, offset_x, offset_y):
-        win.blit(self.sprite, (self.rect.x - offset_x, self.rect.y - offset_y))
+    def draw(self, win, offset_x, offset_y, alpha=1, zoom=1):
+        win.blit(*self.blit_item(offset_x, offset_y, alpha, zoom))
 
 
 # function to get the background
 def get_background(name):
-    # get the path to the background image
-    image = pygame.image.load(join("assets", "Background", name))
+    # get the background image from the asset cache
+    image = asset_cache.load_image(join("assets", "Background", name))
     # get the width and height of the image
     _, _, width, height = image.get_rect()
     # create a list to store the background tiles
@@ -323,195 +1367,820 @@ def get_background(name):
             # add the tile to the list
             tiles.append(pos)
 
-    # add the tile to the list
-    return tiles, image
+    # draw all the tiles onto one screen sized surface so drawing the background is a single blit
+    def build():
+        baked = pygame.Surface((WIDTH, HEIGHT)).convert()
+        for pos in tiles:
+            baked.blit(image, pos)
+        return baked
+
+    # return the one position and the pre-drawn background
+    return [(0, 0)], asset_cache.get(("background", name, WIDTH, HEIGHT), build)
+
+# class that keeps fonts and rendered text around so the same text is not rendered every frame
+class TextCache:
+    def __init__(self, max_items=128):
+        self.max_items = max_items  # how many rendered texts to keep
+        self.fonts = {}  # (font name, size) -> font
+        self.surfaces = OrderedDict()  # (font name, size, text, color) -> rendered text, least recently used first
+
+    # method to get a font, fonts are only loaded once
+    def font(self, size, name=None):
+        font = self.fonts.get((name, size))
+        if font is None:
+            font = pygame.font.Font(name, size)
+            self.fonts[(name, size)] = font
+        return font
+
+    # method to render text, or get it from the cache if it was rendered before
+    def render(self, text, size, color=(255, 255, 255), name=None):
+        key = (name, size, text, color)
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.surfaces.move_to_end(key)
+            return surface
+
+        surface = self.font(size, name).render(text, True, color)
+        self.surfaces[key] = surface
+        # forget the least recently used text when there is too much
+        if len(self.surfaces) > self.max_items:
+            self.surfaces.popitem(last=False)
+        return surface
+
+
+# shared text cache used by all the screens
+text_cache = TextCache()
+
+
+# class for a piece of HUD text (lives, timers, scores, player labels...)
+# it keeps its rendered surface and only renders again when its values change
+class HudLabel:
+    def __init__(self, template, position, size=36, color=(255, 255, 255), name=None):
+        self.template = template  # format string, e.g. "Lives: {}"
+        self.position = position
+        self.size = size
+        self.color = color
+        self.name = name
+        self.values = None  # values the surface was rendered with
+        self.surface = None
+
+    # method to draw the label with the given values, returns the rect that was drawn
+    def draw(self, win, *values):
+        if values != self.values:
+            self.values = values
+            self.surface = text_cache.render(self.template.format(*values), self.size, self.color, self.name)
+        return win.blit(self.surface, self.position)
+
+
+# label showing the lives left
+lives_label = HudLabel("Lives: {}", (10, 10))
+
+
+# class for a named timer used with "with", adds its time to the profiler
+class ProfileScope:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, self.start, time.perf_counter())
+        return False
+
+
+# scope that does nothing, used while the profiler is off so timing costs next to nothing
+class NullScope:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SCOPE = NullScope()
+
+
+# class that times each part of the frame (physics, collisions, drawing...)
+# it can show an overlay with a frame time graph and export a trace for chrome://tracing or Perfetto
+class Profiler:
+    def __init__(self, history=240, max_events=200000):
+        self.enabled = False
+        self.overlay = False  # show the overlay on screen
+        self.history = history  # how many frames the graph and the stats cover
+        self.max_events = max_events  # most trace events kept, so a long session doesn't use all the memory
+        self.scopes = {}  # name -> ProfileScope, made once per name
+        self.frame_times = deque(maxlen=history)  # frame times in seconds
+        self.frame_scopes = deque(maxlen=history)  # time of each scope per frame
+        self.current = {}  # time of each scope this frame
+        self.events = []  # trace events
+        self.origin = time.perf_counter()  # trace times start here
+        self.frame_start = None
+        self.overlay_lines = []  # overlay text, updated a few times a second
+        self.overlay_frame = 0
+
+    # method to turn the profiler (and its overlay) on or off
+    def toggle(self):
+        self.enabled = not self.enabled
+        self.overlay = self.enabled
+        self.frame_start = None
+
+    # method to get a scope to time a part of the frame with "with profiler.scope(name):"
+    def scope(self, name):
+        if not self.enabled:
+            return NULL_SCOPE
+        scope = self.scopes.get(name)
+        if scope is None:
+            scope = ProfileScope(self, name)
+            self.scopes[name] = scope
+        return scope
+
+    # method called by scopes when they end
+    def record(self, name, start, end):
+        self.current[name] = self.current.get(name, 0) + end - start
+        if len(self.events) < self.max_events:
+            self.events.append({
+                "name": name, "ph": "X", "pid": 0, "tid": 0,
+                "ts": (start - self.origin) * 1000000, "dur": (end - start) * 1000000,
+            })
+
+    # method called once per frame, between two frames
+    def next_frame(self):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self.frame_start is not None:
+            self.frame_times.append(now - self.frame_start)
+            self.frame_scopes.append(self.current)
+            self.record("frame", self.frame_start, now)
+        self.current = {}
+        self.frame_start = now
+
+    # method to get a percentile of the frame times in milliseconds
+    def percentile(self, percent):
+        if not self.frame_times:
+            return 0
+        times = sorted(self.frame_times)
+        return times[min(len(times) - 1, int(len(times) * percent / 100))] * 1000
+
+    # method to draw the overlay (graph of frame times, p50/p99 and the time of each scope)
+    def draw(self, win):
+        if not self.overlay:
+            return None
+        graph_width, graph_height = self.history, 60
+        panel = pygame.Rect(win.get_width() - graph_width - 20, 10, graph_width + 10, graph_height + 20)
+
+        # the text is only updated every half second so it can be read
+        self.overlay_frame += 1
+        if self.overlay_frame % (FPS // 2) == 1:
+            self.overlay_lines = [f"p50 {self.percentile(50):.1f} ms  p99 {self.percentile(99):.1f} ms"]
+            totals = {}
+            for scopes in self.frame_scopes:
+                for name, seconds in scopes.items():
+                    totals[name] = totals.get(name, 0) + seconds
+            frames = max(1, len(self.frame_scopes))
+            for name, seconds in sorted(totals.items(), key=lambda item: -item[1]):
+                self.overlay_lines.append(f"{name}: {seconds / frames * 1000:.2f} ms")
+        panel.height += 20 * len(self.overlay_lines)
+
+        pygame.draw.rect(win, (0, 0, 0), panel)
+        # one bar per frame, the line is the 60 fps budget
+        budget = 1000 / FPS
+        for i, seconds in enumerate(self.frame_times):
+            bar = min(graph_height, seconds * 1000 / (budget * 2) * graph_height)
+            color = (0, 200, 0) if seconds * 1000 <= budget else (220, 0, 0)
+            pygame.draw.line(win, color, (panel.x + 5 + i, panel.y + 10 + graph_height), (panel.x + 5 + i, panel.y + 10 + graph_height - bar))
+        budget_y = panel.y + 10 + graph_height // 2
+        pygame.draw.line(win, (255, 255, 0), (panel.x + 5, budget_y), (panel.x + 5 + graph_width, budget_y))
+        for i, line in enumerate(self.overlay_lines):
+            win.blit(text_cache.render(line, 20), (panel.x + 5, panel.y + graph_height + 20 + 20 * i))
+        return panel
+
+    # method to save the recorded events in the Chrome trace event format
+    def export(self, path):
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+
+# shared profiler used to time the game
+profiler = Profiler()
+
 
 # function to draw the game over screen
 def draw_game_over(window):
     window.fill((0, 0, 0))  # fill window with black
 
-    font = pygame.font.Font(None, 60) # set the font of the text 
-    text_surface = font.render("Game Over", True, (255, 255, 255)) #type the text
+    text_surface = text_cache.render("Game Over", 60) # type the text with a size 60 font
     text_rect = text_surface.get_rect(center=(WIDTH // 2, HEIGHT // 2))
     window.blit(text_surface, text_rect)
 
-    font = pygame.font.Font(None, 30)
-    restart_text_surface = font.render("Press R to Restart the Level", True, (255, 255, 255))
+    restart_text_surface = text_cache.render("Press R to Restart the Level", 30)
     restart_text_rect = restart_text_surface.get_rect(center=(WIDTH // 2, HEIGHT // 2 + 50))
     window.blit(restart_text_surface, restart_text_rect)
 
-    pygame.display.update()
+# function to draw the loading screen, shown if the next level isn't ready yet
+def draw_loading(window):
+    window.fill((0, 0, 0))  # Fill with black
+    text_surface = text_cache.render("Loading...", 60)
+    window.blit(text_surface, text_surface.get_rect(center=(WIDTH // 2, HEIGHT // 2)))
 
 # function to draw the game winning screen
 def draw_game_win(window):
     window.fill((0, 0, 0))  # Fill with black
 
-    font = pygame.font.Font(None, 60)
-    text_surface = font.render("You Win!", True, (255, 255, 255))
+    text_surface = text_cache.render("You Win!", 60)
     text_rect = text_surface.get_rect(center=(WIDTH // 2, HEIGHT // 2))
     window.blit(text_surface, text_rect)
 
-    font = pygame.font.Font(None, 30)
-    restart_text_surface = font.render("Press R to Restart", True, (255, 255, 255))
+    restart_text_surface = text_cache.render("Press R to Restart", 30)
     restart_text_rect = restart_text_surface.get_rect(center=(WIDTH // 2, HEIGHT // 2 + 50))
     window.blit(restart_text_surface, restart_text_rect)
 
-    pygame.display.update()
 
+# class that keeps track of the parts of the window that changed, so only those are sent to the display
+# static screens (menu, game over, win) are drawn once and then left alone until something changes
+class ScreenUpdater:
+    def __init__(self, dirty_rects=True):
+        self.dirty_rects = dirty_rects  # False sends the whole window to the display every frame
+        self.dirty = []  # rects changed since the last present
+        self.screen = None  # the static screen currently shown, None while playing
+        self.menu_boxes = []  # menu boxes of the menu screen currently shown
+
+    # method to mark part of the window as changed
+    def mark(self, rect):
+        self.dirty.append(pygame.Rect(rect))
+
+    # method to check if a static screen needs to be drawn again
+    def needs_redraw(self, screen):
+        return not self.dirty_rects or self.screen != screen
+
+    # method to force everything to be drawn again (e.g. when the window was covered)
+    def invalidate(self):
+        self.screen = None
+
+    # method to send the changed parts of the window to the display
+    def present(self):
+        if not self.dirty_rects:
+            pygame.display.update()
+        elif self.dirty:
+            pygame.display.update(self.dirty)
+        self.dirty = []
+
+
+# shared screen updater used by draw
+screen_updater = ScreenUpdater()
+
+
+# class for the surfaces the game is drawn on before it reaches the window
+# the world can be drawn smaller than the game size (scale below 1, fewer pixels to fill) and is then scaled up to the window in one pass
+# the window can be any size, everything is laid out at the game size and scaled to fit, so resizing doesn't load anything again
+class RenderTarget:
+    def __init__(self, scale=1, smooth=False, size=(WIDTH, HEIGHT)):
+        self.scale = scale  # size of the world render compared to the game size
+        self.smooth = smooth  # smoothscale the world up, otherwise pixels are repeated (sharp at whole number scales)
+        self.size = size  # game size everything is laid out in
+        self.world = None  # surface the world is drawn on, when it can't be the window
+        self.screen = None  # game sized surface for the static screens, when the window was resized
+
+    # method to check if the window is the game size, then things are drawn on it directly
+    def native(self, window):
+        return window.get_size() == self.size
+
+    # method to get a rect of the game size in world render pixels
+    def scaled(self, rect):
+        left, top = round(rect.left * self.scale), round(rect.top * self.scale)
+        return pygame.Rect(left, top, round(rect.right * self.scale) - left, round(rect.bottom * self.scale) - top)
+
+    # method to get the surface to draw the world on, made again if the scale changed
+    def world_surface(self, window):
+        if self.scale == 1 and self.native(window):
+            return window
+        size = self.scaled(pygame.Rect((0, 0), self.size)).size
+        if self.world is None or self.world.get_size() != size:
+            self.world = pygame.Surface(size).convert()
+        return self.world
+
+    # method to scale the world render up to the window
+    def present_world(self, window):
+        if self.world_surface(window) is window:
+            return
+        if self.smooth:
+            pygame.transform.smoothscale(self.world, window.get_size(), window)
+        else:
+            pygame.transform.scale(self.world, window.get_size(), window)
 
-# function to draw the whole game on the window
-def draw(window, background, bg_image, players, objects, exit, offset_x, offset_y, lives, game_state):
-    menu_boxes = []  # Initialize menu_boxes
+    # method to get the surface to draw a static screen (menu, game over, win) on
+    def screen_surface(self, window):
+        if self.native(window):
+            return window
+        if self.screen is None:
+            self.screen = pygame.Surface(self.size).convert()
+        return self.screen
+
+    # method to scale a static screen up to the window
+    def present_screen(self, window):
+        if not self.native(window):
+            pygame.transform.smoothscale(self.screen, window.get_size(), window)
+
+    # method to turn a position in the window (like the mouse) into game coordinates
+    def to_game(self, pos):
+        window = pygame.display.get_surface()
+        if window is None or self.native(window):
+            return pos
+        return pos[0] * self.size[0] // window.get_width(), pos[1] * self.size[1] // window.get_height()
+
+
+# shared render target used by draw
+render_target = RenderTarget()
 
-    if game_state == MENU:
-        menu_boxes = draw_menu(window)
-    elif game_state == GAME:
-        # Draw the background
-        for tile in background:
-            window.blit(bg_image, tile)
 
-        # Draw the objects
+# function to draw the level, the players and everything in it onto one camera view
+def draw_world(win, players, objects, exit, offset_x, offset_y, alpha=1, zoom=1):
+    # Draw the objects
+    with profiler.scope("draw.terrain"):
         for obj in objects:
-            obj.draw(window, offset_x, offset_y)
-        
-        #Draw the exit
-        exit.draw(window, offset_x, offset_y)
+            obj.draw(win, offset_x, offset_y, zoom)
 
-        # Draw the player(s)
-        for player in players:
-            player.draw(window, offset_x, offset_y)
-
-        # Draw lives
-        font = pygame.font.Font(None, 36)
-        text = font.render(f"Lives: {lives}", True, (255, 255, 255))
-        window.blit(text, (10, 10))
-    elif game_state == GAME_OVER:
-        draw_game_over(window)
-    elif game_state == GAME_WIN:
-        draw_game_win(window)
-
-    # Update the display
-    pygame.display.update()
+    #Draw the exit and the player(s), in one batch
+    sprites = [exit.blit_item(offset_x, offset_y, zoom)]
+    sprites += [player.blit_item(offset_x, offset_y, alpha, zoom) for player in players]
+    win.blits(sprites, doreturn=False)
+
+
+# function to draw the whole game on the window
+# cameras (a CameraRig) draws every camera view, without it the window is one view at offset_x, offset_y
+def draw(window, background, bg_image, players, objects, exit, offset_x, offset_y, lives, game_state, alpha=1, cameras=None):
+    menu_boxes = []  # Initialize menu_boxes
+
+    if game_state in (MENU, GAME_OVER, GAME_WIN):
+        # static screens are only drawn when they first show up
+        if screen_updater.needs_redraw(game_state):
+            screen = render_target.screen_surface(window)
+            if game_state == MENU:
+                screen_updater.menu_boxes = draw_menu(screen)
+            elif game_state == GAME_OVER:
+                draw_game_over(screen)
+            else:
+                draw_game_win(screen)
+            render_target.present_screen(window)
+            screen_updater.mark(window.get_rect())
+            screen_updater.screen = game_state
+        if game_state == MENU:
+            menu_boxes = screen_updater.menu_boxes
+    elif game_state == GAME:
+        # the camera moves every frame, so the whole window changes
+        screen_updater.screen = None
+        # the world is drawn at the render scale (the window itself at full size)
+        world = render_target.world_surface(window)
+        scale = render_target.scale
+        # Draw the background (it doesn't move with the camera, so it is drawn once for every view)
+        with profiler.scope("draw.background"):
+            image = zoomed(bg_image, scale)
+            for x, y in background:
+                world.blit(image, (round(x * scale), round(y * scale)))
+        if cameras is None:
+            draw_world(world, players, objects, exit, offset_x, offset_y, alpha, scale)
+        else:
+            # each camera draws into its own part of the world render
+            for camera in cameras.cameras:
+                view_x, view_y = camera.offset(alpha)
+                draw_world(world.subsurface(render_target.scaled(camera.viewport)), players, objects, exit, view_x, view_y, alpha, camera.zoom * scale)
+        # scale the world up to the window in one pass
+        with profiler.scope("draw.upscale"):
+            render_target.present_world(window)
+        if cameras is not None:
+            cameras.draw_lines(window)
+
+        # Draw lives (only rendered again when the number of lives changes)
+        lives_label.draw(window, lives)
+        # Draw the profiler overlay if it is on
+        profiler.draw(window)
+        screen_updater.mark(window.get_rect())
+
+    # Update the changed parts of the display
+    with profiler.scope("display.update"):
+        screen_updater.present()
     return menu_boxes
 
 
-# method to handle vertical collisions
-def handle_vertical_collision(player, objects, dy):
-    # create a list to store the collided objects
-    collided_objects = []
-    # loop through each object
-    for obj in objects:
-        if pygame.sprite.collide_mask(player, obj):
-            if dy > 0:
-                player.rect.bottom = obj.rect.top
-                player.landed()  # Call landed when player touches the ground
-            elif dy < 0:
-                player.rect.top = obj.rect.bottom
-                player.hit_head()
-
-            collided_objects.append(obj)
-
-    # returns list of collided objects
-    return collided_objects
-
-
-# method to check for player collition
-def collide(player, objects, dx):
-    # move the player by amount
-    player.move(dx, 0)
-    # update the player
-    player.update()
-    # initialize collided object to none (meaning there is no colision)
-    collided_object = None
-    # loop through each object
-    for obj in objects:
-        if pygame.sprite.collide_mask(player, obj):
-            # set the collided object
-            collided_object = obj
+# function to find how far a rect can move along one axis (dx or dy, the other one is 0) before hitting an object
+# returns the distance it can move on each axis and the object it hits first (or None)
+def sweep_axis(rect, objects, dx, dy):
+    # only the objects in the area the rect passes through can be hit
+    swept = rect.union(rect.move(dx, dy))
+    hit = None
+    for obj in query_objects(objects, swept):
+        other = obj.rect
+        # objects the rect is already inside are ignored so it can get out of them
+        if dx > 0 and rect.right <= other.left <= rect.right + dx:
+            dx, hit = other.left - rect.right, obj
+        elif dx < 0 and rect.left + dx <= other.right <= rect.left:
+            dx, hit = other.right - rect.left, obj
+        elif dy > 0 and rect.bottom <= other.top <= rect.bottom + dy:
+            dy, hit = other.top - rect.bottom, obj
+        elif dy < 0 and rect.top + dy <= other.bottom <= rect.top:
+            dy, hit = other.bottom - rect.top, obj
+    return dx, dy, hit
+
+
+# function to move the player by (dx, dy), stopping at the objects in the way
+# the move is split into sub-steps of at most SWEEP_STEP pixels, each sweeping x then y, so corners are
+# resolved the same way at any speed and nothing is skipped however fast the player falls
+# returns the objects that were hit
+def move_and_collide(player, objects, dx, dy):
+    # rects only hold whole pixels
+    dx, dy = round(dx), round(dy)
+    steps = max(1, math.ceil(max(abs(dx), abs(dy)) / SWEEP_STEP))
+    hits = []
+    blocked_x = blocked_y = False
+    for step in range(steps):
+        # split the move into whole pixels that add up to dx and dy
+        step_dx = dx * (step + 1) // steps - dx * step // steps
+        step_dy = dy * (step + 1) // steps - dy * step // steps
+
+        if step_dx and not blocked_x:
+            step_dx, _, hit = sweep_axis(player.rect, objects, step_dx, 0)
+            player.move(step_dx, 0)
+            if hit is not None:
+                # stopped by a wall
+                blocked_x = True
+                hits.append(hit)
+
+        if step_dy and not blocked_y:
+            _, step_dy, hit = sweep_axis(player.rect, objects, 0, step_dy)
+            player.move(0, step_dy)
+            if hit is not None:
+                blocked_y = True
+                hits.append(hit)
+                if dy > 0:
+                    player.landed(hit.rect.top)  # Call landed when player touches the ground
+                else:
+                    player.hit_head()
+
+        if (blocked_x or not dx) and (blocked_y or not dy):
             break
 
-    # move the player by specified amount
-    player.move(-dx, 0)
-    # update player
-    player.update()
-    # return collided object
-    return collided_object
+    return hits
 
 
 # Method that handles the movement of the player based on their keybindings
-def handle_player_input(player, keys, bindings, collide_left, collide_right):
-    if keys[bindings["left"]] and not collide_left:
+def handle_player_input(player, keys, bindings):
+    if keys[bindings["left"]]:
         player.move_left(PLAYER_VEL)
-    if keys[bindings["right"]] and not collide_right:
+    if keys[bindings["right"]]:
         player.move_right(PLAYER_VEL)
     if keys[bindings["jump"]] and player.jump_count < 1:
         player.jump()
 
 
+# function to check if something is right below the player
 def is_on_ground(player, objects):
-    # Create a rect below the player
+    # a strip one pixel tall right below the player
     player_rect = player.rect
-
-    # check for collisions along the width of the player
-    for x_offset in range(0, player_rect.width, 4):  # Increment by 5 to make less intensive checks for perfomance
-        temp_rect = pygame.Rect(player_rect.x + x_offset, player_rect.bottom + 1, 1, 1)
-        for obj in objects:
-            if temp_rect.colliderect(obj.rect):
-                return True
-    return False
+    strip = pygame.Rect(player_rect.x, player_rect.bottom, player_rect.width, 1)
+    # test the strip against the nearby objects in one query
+    return bool(query_objects(objects, strip))
 
 
 # method handling movement of the players
-def handle_move(players, objects, lives):
-    keys = pygame.key.get_pressed()
-    hit_this_frame = False  # Flag to track if any player was hit this frame
+def handle_move(players, objects, keys=None):
+    # read the keyboard unless the keys were given (e.g. scripted input)
+    if keys is None:
+        keys = pygame.key.get_pressed()
 
     for i, player in enumerate(players):
         # reset the player(s) velocity
         player.x_vel = 0
-        # check for collision with objects left and right
-        collide_left = collide(player, objects, -PLAYER_VEL * 2)
-        collide_right = collide(player, objects, PLAYER_VEL * 2)
-
         # handle movement (keybinds)
-        handle_player_input(player, keys, PLAYER_BINDINGS[i], collide_left, collide_right)
-
-        player.on_ground = is_on_ground(player, objects)  # check if on the ground before all other collision checks
-
-        # handle vertical collisions
-        vertical_collide = handle_vertical_collision(player, objects, player.y_vel)
-
-        # check for collisions with other objects
-        to_check = [collide_left, collide_right, *vertical_collide]
-
-        # Future function for entity damage
-        # loop through each object to check
-        # for obj in to_check:
-        #      #check if the object is an entity
-        #      if obj and obj.name == "": #Check if object is an entity
-        #         if pygame.time.get_ticks() - player.last_hit_time > 1000: # prevent players from taking infinite damage
-        #             #make the player hit if colliding with the entity
-        #              player.make_hit()
-        #              hit_this_frame = True # signal signifying the player was hit
-
-    if hit_this_frame:  # Decrease lives only if a player has been hit in this frame
-        lives -= 1
-    return lives
-
-# function for the camera following player one
-#TODO make it so camera takes into account other players
-def camera_follow(player, offset_x, offset_y, level_width, level_height):
-    offset_x = max(0, min(level_width - WIDTH, player.rect.centerx - WIDTH // 2))
-    offset_y = max(0, min(level_height - HEIGHT, player.rect.centery - HEIGHT // 2))
-
-    return offset_x, offset_y
+        handle_player_input(player, keys, PLAYER_BINDINGS[i])
+
+        # move the player, stopping at walls, floors and ceilings
+        with profiler.scope("move_and_collide"):
+            move_and_collide(player, objects, player.x_vel, player.y_vel)
+
+        # check if the player is standing on something after moving
+        with profiler.scope("is_on_ground"):
+            player.on_ground = is_on_ground(player, objects)
+
+    # damage from hazards is checked for every player at once by HazardPool.resolve_damage after this
+
+# function to make a grid of solid cells for a level's tile map and blocks (a numpy array of bools)
+# only tiles and blocks of tile_size lined up on one grid are included, returns the grid and its world origin
+def solid_grid(tilemap, blocks, tile_size=BLOCK_SIZE):
+    xs = []
+    ys = []
+    if tilemap is not None and tilemap.tile_size == tile_size and len(tilemap.tiles):
+        tiles = numpy.frombuffer(tilemap.tiles, dtype=numpy.uint16).reshape(tilemap.rows, tilemap.columns)
+        rows, columns = numpy.nonzero(tiles)
+        xs.append(tilemap.origin_x + columns * tile_size)
+        ys.append(tilemap.origin_y + rows * tile_size)
+    if blocks is not None and len(blocks):
+        sizes = numpy.frombuffer(blocks.sizes, dtype=numpy.uint16)
+        xs.append(numpy.frombuffer(blocks.xs, dtype=numpy.int32)[sizes == tile_size])
+        ys.append(numpy.frombuffer(blocks.ys, dtype=numpy.int32)[sizes == tile_size])
+    xs = numpy.concatenate(xs).astype(numpy.int64) if xs else numpy.zeros(0, numpy.int64)
+    ys = numpy.concatenate(ys).astype(numpy.int64) if ys else numpy.zeros(0, numpy.int64)
+    if not len(xs):
+        return numpy.zeros((0, 0), dtype=bool), 0, 0
+
+    origin_x, origin_y = int(xs.min()), int(ys.min())
+    on_grid = ((xs - origin_x) % tile_size == 0) & ((ys - origin_y) % tile_size == 0)
+    columns = (xs[on_grid] - origin_x) // tile_size
+    rows = (ys[on_grid] - origin_y) // tile_size
+    grid = numpy.zeros((int(rows.max()) + 1, int(columns.max()) + 1), dtype=bool)
+    grid[rows, columns] = True
+    return grid, origin_x, origin_y
+
+
+# class that runs the physics of many entities (enemies, projectiles...) at once with numpy
+# positions, velocities, fall counters and ground flags are kept in arrays, and gravity, movement and
+# collisions with the level's tile grid are done for every entity in a few array operations
+# it follows the same rules as the players (Player.loop and move_and_collide) but collides with the tile grid only
+class EntityPhysics:
+    def __init__(self, capacity=256):
+        if numpy is None:
+            raise ImportError("EntityPhysics needs numpy (pip install numpy)")
+        self.capacity = 0
+        self.size = 0  # slots used so far, free slots below this are reused first
+        self.free = []  # indexes of removed entities, reused by add
+        self.x = self.y = self.x_vel = self.y_vel = self.width = self.height = None
+        self.fall_count = self.on_ground = self.hit_wall = self.active = None
+        self.grow(capacity)
+        self.solid = numpy.zeros((0, 0), dtype=bool)  # solid cells of the level
+        self.origin_x = 0
+        self.origin_y = 0
+        self.tile_size = BLOCK_SIZE
+
+    # method to make room for more entities, keeping the ones already there
+    def grow(self, capacity):
+        def resize(values, dtype):
+            grown = numpy.zeros(capacity, dtype=dtype)
+            if values is not None:
+                grown[:len(values)] = values
+            return grown
+
+        self.x = resize(self.x, numpy.float64)
+        self.y = resize(self.y, numpy.float64)
+        self.x_vel = resize(self.x_vel, numpy.float64)
+        self.y_vel = resize(self.y_vel, numpy.float64)
+        self.width = resize(self.width, numpy.float64)
+        self.height = resize(self.height, numpy.float64)
+        self.fall_count = resize(self.fall_count, numpy.int32)
+        self.on_ground = resize(self.on_ground, bool)
+        self.hit_wall = resize(self.hit_wall, numpy.int8)  # -1 or 1 when a wall stopped the entity this tick
+        self.active = resize(self.active, bool)
+        self.capacity = capacity
+
+    # method to use the tiles and blocks of a level for collisions
+    def set_level(self, current_level):
+        self.solid, self.origin_x, self.origin_y = solid_grid(current_level.tilemap, current_level.blocks, self.tile_size)
+
+    # method to add an entity, returns its index
+    def add(self, x, y, width, height, x_vel=0, y_vel=0):
+        if self.free:
+            index = self.free.pop()
+        else:
+            if self.size == self.capacity:
+                self.grow(self.capacity * 2)
+            index = self.size
+            self.size += 1
+        self.x[index], self.y[index] = x, y
+        self.x_vel[index], self.y_vel[index] = x_vel, y_vel
+        self.width[index], self.height[index] = width, height
+        self.fall_count[index] = 0
+        self.on_ground[index] = False
+        self.hit_wall[index] = 0
+        self.active[index] = True
+        return index
+
+    # method to remove an entity, its slot is reused by the next add
+    def remove(self, index):
+        if self.active[index]:
+            self.active[index] = False
+            self.free.append(index)
+
+    # method to get the indexes of the entities in use
+    def indexes(self):
+        return numpy.flatnonzero(self.active[:self.size])
+
+    # method to get the rect of an entity (for drawing and overlap checks)
+    def rect(self, index):
+        return pygame.Rect(round(self.x[index]), round(self.y[index]), int(self.width[index]), int(self.height[index]))
+
+    # method to check which cells are solid, cells outside the grid are empty
+    def solid_at(self, columns, rows):
+        grid = self.solid
+        inside = (columns >= 0) & (rows >= 0) & (columns < grid.shape[1]) & (rows < grid.shape[0])
+        result = numpy.zeros(columns.shape, dtype=bool)
+        result[inside] = grid[rows[inside], columns[inside]]
+        return result
+
+    # method to get the cells an edge of each entity touches along its side
+    # start and end are the sides of each entity across the edge, line is the cell of the edge itself
+    def edge_cells(self, start, end, origin):
+        first = numpy.floor((start - origin) / self.tile_size).astype(numpy.int64)
+        last = numpy.ceil((end - origin) / self.tile_size).astype(numpy.int64) - 1
+        spread = int((last - first).max()) + 1 if len(first) else 1
+        # every entity checks the same number of cells, the extra ones repeat its last cell
+        return numpy.minimum(first[:, None] + numpy.arange(spread), last[:, None])
+
+    # method to move the entities along one axis by delta, stopping them at the first solid cell they enter
+    # position and length are on the moving axis, side and side_length across it; returns the new positions and
+    # -1, 0 or 1 for the entities stopped while moving back, not stopped, or stopped while moving forward
+    def sweep(self, position, length, delta, side, side_length, vertical):
+        size = self.tile_size
+        origin = self.origin_y if vertical else self.origin_x
+        side_origin = self.origin_x if vertical else self.origin_y
+        moved = position + delta
+        forward = delta > 0
+        # the cell of the leading edge before and after the move (moves are shorter than a cell)
+        before = numpy.where(forward, numpy.ceil((position + length - origin) / size) - 1, numpy.floor((position - origin) / size))
+        after = numpy.where(forward, numpy.ceil((moved + length - origin) / size) - 1, numpy.floor((moved - origin) / size))
+        entered = (after != before) & (delta != 0)
+        lines = after.astype(numpy.int64)[:, None]
+        cells = self.edge_cells(side, side + side_length, side_origin)
+        if vertical:
+            hit = entered & self.solid_at(cells, numpy.broadcast_to(lines, cells.shape)).any(axis=1)
+        else:
+            hit = entered & self.solid_at(numpy.broadcast_to(lines, cells.shape), cells).any(axis=1)
+        # put the stopped entities right against the cell they ran into
+        moved = numpy.where(hit & forward, origin + after * size - length, moved)
+        moved = numpy.where(hit & ~forward, origin + (after + 1) * size, moved)
+        return moved, numpy.where(hit, numpy.where(forward, 1, -1), 0)
+
+    # method to run one physics tick for every entity
+    def step(self, fps=FPS):
+        index = self.indexes()
+        if not len(index):
+            return
+        x, y = self.x[index], self.y[index]
+        x_vel, y_vel = self.x_vel[index], self.y_vel[index]
+        width, height = self.width[index], self.height[index]
+        fall_count = self.fall_count[index]
+
+        # gravity for the entities that are not on the ground (same as Player.loop)
+        y_vel = numpy.where(self.on_ground[index], y_vel, y_vel + numpy.minimum(1, fall_count / fps * GRAVITY))
+
+        # split fast moves into sub-steps shorter than a cell, so no entity skips over a solid cell
+        # entities that fell below the level can't hit anything, so their speed doesn't add sub-steps
+        in_level = y < self.origin_y + self.solid.shape[0] * self.tile_size
+        fastest = max(numpy.abs(x_vel).max(), numpy.abs(y_vel[in_level]).max(initial=0))
+        steps = max(1, math.ceil(fastest / min(SWEEP_STEP, self.tile_size - 1)))
+        hit_x = numpy.zeros(len(index), dtype=numpy.int8)
+        hit_y = numpy.zeros(len(index), dtype=numpy.int8)
+        for _ in range(steps):
+            # entities stop moving on an axis once they hit something on it
+            x, stopped = self.sweep(x, width, numpy.where(hit_x == 0, x_vel / steps, 0), y, height, False)
+            hit_x = numpy.where(hit_x == 0, stopped, hit_x)
+            y, stopped = self.sweep(y, height, numpy.where(hit_y == 0, y_vel / steps, 0), x, width, True)
+            hit_y = numpy.where(hit_y == 0, stopped, hit_y)
+
+        # landing stops the fall, hitting a ceiling bounces the entity back down (like Player.landed and hit_head)
+        landed = hit_y == 1
+        y_vel = numpy.where(landed, 0, numpy.where(hit_y == -1, -y_vel, y_vel))
+        fall_count = numpy.where(landed, 0, fall_count + 1)
+
+        # an entity is on the ground when it rests exactly on top of a solid cell
+        bottom = y + height - self.origin_y
+        flush = numpy.mod(bottom, self.tile_size) == 0
+        below = (bottom // self.tile_size).astype(numpy.int64)[:, None]
+        cells = self.edge_cells(x, x + width, self.origin_x)
+        on_ground = flush & self.solid_at(cells, numpy.broadcast_to(below, cells.shape)).any(axis=1)
+
+        self.x[index], self.y[index] = x, y
+        self.y_vel[index] = y_vel
+        self.fall_count[index] = fall_count
+        self.on_ground[index] = on_ground
+        self.hit_wall[index] = hit_x
+
+
+# class for a camera showing part of the level in a viewport (an area of the window)
+# it keeps its target players in view, a group camera zooms out to fit all of them
+class Camera:
+    def __init__(self, viewport, targets=(0,), group=False):
+        self.viewport = pygame.Rect(viewport)
+        self.targets = targets  # indexes of the players it follows
+        self.group = group
+        self.zoom = 1
+        self.x, self.y = 0, 0  # top left of the view in the level
+        self.prev_x, self.prev_y = 0, 0  # position at the previous tick, for blending when drawing
+
+    # method to get the part of the level the camera shows
+    def view(self):
+        return pygame.Rect(self.x, self.y, math.ceil(self.viewport.width / self.zoom), math.ceil(self.viewport.height / self.zoom))
+
+    # method to pick the closest zoom that fits an area of the level with a margin around it
+    # zooming back in needs some extra room, so players at the edge of a zoom don't make it flicker
+    def fit_zoom(self, area):
+        width = area.width + CAMERA_MARGIN * 2
+        height = area.height + CAMERA_MARGIN * 2
+        for zoom in ZOOM_LEVELS:
+            room = ZOOM_IN_ROOM if zoom > self.zoom else 1
+            if width * room <= self.viewport.width / zoom and height * room <= self.viewport.height / zoom:
+                return zoom
+        return ZOOM_LEVELS[-1]
+
+    # method to move the camera to its players, called once a tick
+    # snap jumps straight there instead of blending from where it was (new level, restart...)
+    def follow(self, players, level_width, level_height, snap=False):
+        self.prev_x, self.prev_y = self.x, self.y
+        rects = [players[i].rect for i in self.targets if i < len(players)]
+        if not rects:
+            return
+        area = rects[0].unionall(rects[1:])
+        if self.group:
+            self.zoom = self.fit_zoom(area)
+        view_width, view_height = self.view().size
+        self.x = max(0, min(level_width - view_width, area.centerx - view_width // 2))
+        self.y = max(0, min(level_height - view_height, area.centery - view_height // 2))
+        if snap:
+            self.prev_x, self.prev_y = self.x, self.y
+
+    # method to get where to draw from, alpha blends between the previous tick (0) and the current one (1)
+    def offset(self, alpha=1):
+        return round(self.prev_x + (self.x - self.prev_x) * alpha), round(self.prev_y + (self.y - self.prev_y) * alpha)
+
+
+# function to split the window into viewports, side by side for two players and in quarters for three or four
+def split_viewports(num_players, size=(WIDTH, HEIGHT)):
+    width, height = size
+    if num_players <= 1:
+        return [pygame.Rect(0, 0, width, height)]
+    if num_players == 2:
+        return [pygame.Rect(0, 0, width // 2, height), pygame.Rect(width // 2, 0, width - width // 2, height)]
+    return [
+        pygame.Rect(0, 0, width // 2, height // 2),
+        pygame.Rect(width // 2, 0, width - width // 2, height // 2),
+        pygame.Rect(0, height // 2, width // 2, height - height // 2),
+        pygame.Rect(width // 2, height // 2, width - width // 2, height - height // 2),
+    ]
+
+
+# class for the cameras of the game, in one of the CAMERA_MODES
+# every camera draws the same pre-drawn terrain chunks (and their scaled copies), so more views don't draw the level again
+class CameraRig:
+    def __init__(self, mode=CAMERA_MODES[0], size=(WIDTH, HEIGHT)):
+        self.mode = mode
+        self.size = size
+        self.cameras = [Camera((0, 0, *size))]
+
+    # method to make the cameras for a number of players
+    def setup(self, num_players):
+        everyone = tuple(range(num_players))
+        if self.mode == "group":
+            self.cameras = [Camera((0, 0, *self.size), everyone, group=True)]
+        elif self.mode == "split" and num_players > 1:
+            viewports = split_viewports(num_players, self.size)
+            self.cameras = [Camera(viewport, (i,)) for i, viewport in enumerate(viewports[:num_players])]
+            # with three players the spare quarter shows all of them
+            for viewport in viewports[num_players:]:
+                self.cameras.append(Camera(viewport, everyone, group=True))
+        else:
+            self.cameras = [Camera((0, 0, *self.size))]
+
+    # method to switch to the next camera mode
+    def next_mode(self, num_players):
+        self.mode = CAMERA_MODES[(CAMERA_MODES.index(self.mode) + 1) % len(CAMERA_MODES)]
+        self.setup(num_players)
+
+    # method to move every camera to its players
+    def follow(self, players, level_width, level_height, snap=False):
+        for camera in self.cameras:
+            camera.follow(players, level_width, level_height, snap)
+
+    # method to get the parts of the level the cameras show
+    def views(self):
+        return [camera.view() for camera in self.cameras]
+
+    # method to save the camera positions, for snapshots
+    def snapshot(self):
+        return tuple((camera.x, camera.y, camera.zoom) for camera in self.cameras)
+
+    # method to put the cameras back where they were in a snapshot
+    def restore(self, state):
+        for camera, (x, y, zoom) in zip(self.cameras, state):
+            camera.x, camera.y, camera.zoom = x, y, zoom
+            camera.prev_x, camera.prev_y = x, y
+
+    # method to draw the lines between split screen views, scaled from the game size to the window
+    def draw_lines(self, win):
+        scale_x = win.get_width() / self.size[0]
+        scale_y = win.get_height() / self.size[1]
+        for camera in self.cameras[1:]:
+            viewport = pygame.Rect(round(camera.viewport.x * scale_x), round(camera.viewport.y * scale_y), round(camera.viewport.w * scale_x), round(camera.viewport.h * scale_y))
+            if viewport.left > 0:
+                pygame.draw.line(win, (0, 0, 0), (viewport.left, viewport.top), (viewport.left, viewport.bottom), SPLIT_LINE_WIDTH)
+            if viewport.top > 0:
+                pygame.draw.line(win, (0, 0, 0), (viewport.left, viewport.top), (viewport.right, viewport.top), SPLIT_LINE_WIDTH)
 
 
 def draw_menu(window):
     window.fill((0, 0, 0))  # Fill with black
 
-    font = pygame.font.Font(None, 60)
-    text_surface = font.render("Select Number of Players", True, (255, 255, 255))
+    text_surface = text_cache.render("Select Number of Players", 60)
     text_rect = text_surface.get_rect(center=(WIDTH // 2, HEIGHT // 4))
     window.blit(text_surface, text_rect)
 
@@ -519,7 +2188,7 @@ def draw_menu(window):
     y_offset = HEIGHT // 2
     menu_boxes = []
     for i, option in enumerate(options):
-        option_surface = font.render(option, True, (255, 255, 255))
+        option_surface = text_cache.render(option, 60)
         option_rect = option_surface.get_rect(center=(WIDTH // 2, y_offset))
 
         # Create rectangle behind the text
@@ -533,58 +2202,1204 @@ def draw_menu(window):
 
 def handle_menu_input(event, menu_boxes):
     if event.type == pygame.MOUSEBUTTONDOWN:
-        mouse_pos = pygame.mouse.get_pos()
+        mouse_pos = render_target.to_game(pygame.mouse.get_pos())
         for i, box in enumerate(menu_boxes):
             if box.collidepoint(mouse_pos):
                 return i + 2  # Number of players is index (0,1,2) + 2
     return None
 
 
-def load_level(level_path):
+# class for a tileset image cut into a grid of tiles (like a Tiled tileset)
+class Tileset:
+    def __init__(self, first_gid, image, tile_width, tile_height, columns, margin=0, spacing=0):
+        self.first_gid = first_gid  # id of the first tile of this tileset in the map
+        self.image = image  # path to the tileset image
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.columns = columns
+        self.margin = margin
+        self.spacing = spacing
+
+    # method to get the rect of a tile in the tileset image
+    def rect(self, tile):
+        index = tile - self.first_gid
+        x = self.margin + (index % self.columns) * (self.tile_width + self.spacing)
+        y = self.margin + (index // self.columns) * (self.tile_height + self.spacing)
+        return (x, y, self.tile_width, self.tile_height)
+
+
+# the terrain tileset (same as Tiled/Main Tileset.tsx), used when a map doesn't say which tileset it uses
+DEFAULT_TILESET = Tileset(1, join("assets", "Terrain", "Terrain.png"), 48, 48, 7)
+
+
+# function to get the image of a tile at a given size, shared through the asset cache
+def get_tile(tile, tilesets, size):
+    # the tileset a tile belongs to is the last one starting at or before its id
+    tileset = max((t for t in tilesets if t.first_gid <= tile), key=lambda t: t.first_gid)
+    # the block tile uses the same sprite as Block, so json levels and maps look the same
+    if tileset.image == DEFAULT_TILESET.image and tile - tileset.first_gid + 1 == TERRAIN_TILE:
+        return get_block(size)
+    return load_sprite(tileset.image, tileset.rect(tile), size // tileset.tile_width)
+
+
+# class for a grid of tiles stored in one array (one number per cell, 0 is empty)
+# used for levels made of tiles so there isn't a python object for every tile
+class TileMap:
+    def __init__(self, columns, rows, tile_size, origin_x=0, origin_y=0, tiles=None, tilesets=None):
+        self.columns = columns
+        self.rows = rows
+        self.tile_size = tile_size  # size of a tile in the game
+        self.origin_x = origin_x  # world position of the top left cell
+        self.origin_y = origin_y
+        self.tiles = tiles if tiles is not None else array("H", bytes(2 * columns * rows))
+        self.tilesets = tilesets if tilesets else [DEFAULT_TILESET]
+
+    # method to get the tile in a cell
+    def get(self, column, row):
+        return self.tiles[row * self.columns + column]
+
+    # method to set the tile in a cell
+    def set(self, column, row, tile):
+        self.tiles[row * self.columns + column] = tile
+
+    # method to go through the non empty cells, gives the world position and tile of each
+    def cells(self):
+        tiles = self.tiles
+        for row in range(self.rows):
+            start = row * self.columns
+            y = self.origin_y + row * self.tile_size
+            for column in range(self.columns):
+                tile = tiles[start + column]
+                if tile:
+                    yield self.origin_x + column * self.tile_size, y, tile
+
+    # method to count the non empty cells
+    def count(self):
+        return len(self.tiles) - self.tiles.count(0)
+
+    # method to get the rect around all the non empty cells, or None if there are none
+    def bounds(self):
+        left = top = right = bottom = None
+        for x, y, _ in self.cells():
+            if left is None:
+                left, top, right, bottom = x, y, x, y
+            left, right = min(left, x), max(right, x)
+            top, bottom = min(top, y), max(bottom, y)
+        if left is None:
+            return None
+        return pygame.Rect(left, top, right - left + self.tile_size, bottom - top + self.tile_size)
+
+
+# mask to remove the flip flags Tiled stores in the top bits of a tile id
+TILED_GID_MASK = 0x0FFFFFFF
+
+
+# function to read a Tiled tileset, either inside the map or in its own .tsx file
+def read_tmx_tileset(element, folder):
+    first_gid = int(element.get("firstgid"))
+    if element.get("source"):
+        path = os.path.normpath(join(folder, element.get("source")))
+        element = ElementTree.parse(path).getroot()
+        folder = os.path.dirname(path)
+    image = element.find("image")
+    if image is None:
+        raise ValueError(f"tileset {element.get('name')} has no image (image collection tilesets are not supported)")
+    return Tileset(
+        first_gid,
+        os.path.normpath(join(folder, image.get("source"))),
+        int(element.get("tilewidth")),
+        int(element.get("tileheight")),
+        int(element.get("columns")),
+        int(element.get("margin", 0)),
+        int(element.get("spacing", 0)),
+    )
+
+
+# function to decode the tile ids of a Tiled layer or chunk (csv, base64, zlib or gzip compressed, or xml)
+def decode_tmx_data(element, encoding, compression):
+    if encoding == "csv":
+        return [int(gid) for gid in element.text.split(",") if gid.strip()]
+    if encoding == "base64":
+        raw = base64.b64decode(element.text.strip())
+        if compression == "zlib":
+            raw = zlib.decompress(raw)
+        elif compression == "gzip":
+            raw = gzip.decompress(raw)
+        elif compression:
+            raise ValueError(f"unsupported layer compression: {compression}")
+        # tile ids are stored as little endian 32 bit numbers
+        gids = array("I")
+        gids.frombytes(raw)
+        if sys.byteorder == "big":
+            gids.byteswap()
+        return gids
+    return [int(tile.get("gid", 0)) for tile in element.iter("tile")]
+
+
+# function to read a Tiled map into a tile map, also gives the map's objects and properties
+def read_tmx_map(level_path):
+    root = ElementTree.parse(level_path).getroot()
+    folder = os.path.dirname(level_path)
+    tile_width = int(root.get("tilewidth"))
+    tilesets = [read_tmx_tileset(element, folder) for element in root.findall("tileset")]
+
+    # every tile layer (or every chunk of one, for infinite maps) as (x, y, width, height, tile ids) in tiles
+    pieces = []
+    for layer in root.iter("layer"):
+        data = layer.find("data")
+        encoding = data.get("encoding")
+        compression = data.get("compression")
+        chunks = data.findall("chunk")
+        if chunks:
+            for chunk in chunks:
+                pieces.append((
+                    int(chunk.get("x")), int(chunk.get("y")), int(chunk.get("width")), int(chunk.get("height")),
+                    decode_tmx_data(chunk, encoding, compression),
+                ))
+        else:
+            pieces.append((0, 0, int(layer.get("width")), int(layer.get("height")), decode_tmx_data(data, encoding, compression)))
+
+    # the grid covers every piece (infinite maps can have chunks left of or above 0, 0)
+    if pieces:
+        left = min(piece[0] for piece in pieces)
+        top = min(piece[1] for piece in pieces)
+        right = max(piece[0] + piece[2] for piece in pieces)
+        bottom = max(piece[1] + piece[3] for piece in pieces)
+    else:
+        left = top = right = bottom = 0
+    tilemap = TileMap(right - left, bottom - top, BLOCK_SIZE, left * BLOCK_SIZE, top * BLOCK_SIZE, tilesets=tilesets)
+
+    # later layers are drawn over earlier ones, so their tiles win
+    for x, y, width, _, gids in pieces:
+        for i, gid in enumerate(gids):
+            gid &= TILED_GID_MASK
+            if gid:
+                if gid > 0xFFFF:
+                    raise ValueError(f"{level_path}: tile id {gid} is too big")
+                tilemap.set(x - left + i % width, y - top + i // width, gid)
+
+    # objects placed in the map, with their positions scaled to the game size
+    # there can be many "hazard" objects, they can move with x_vel, y_vel and distance properties (in game pixels)
+    scale = BLOCK_SIZE / tile_width
+    objects = {}
+    hazards = []
+    for obj in root.iter("object"):
+        name = (obj.get("name") or obj.get("type") or obj.get("class") or "").lower()
+        rect = tuple(round(float(obj.get(key, 0)) * scale) for key in ("x", "y", "width", "height"))
+        if name == "hazard":
+            values = {prop.get("name"): float(prop.get("value")) for prop in obj.findall("properties/property")}
+            hazards.append(rect + (values.get("x_vel", 0), values.get("y_vel", 0), values.get("distance", 0)))
+        else:
+            objects[name] = rect
+
+    # only the map's own properties (objects have properties too)
+    properties = {prop.get("name"): prop.get("value") for prop in root.findall("properties/property")}
+    return tilemap, objects, hazards, properties
+
+
+# compiled level format (all little endian):
+#   header: magic, version, tile size, sha256 of the source file, grid columns and rows,
+#           grid origin x and y, player start x and y, exit x, y, width and height (width 0 means no exit)
+#   level name and background name, each as a 2 byte length then utf-8 text
+#   tileset table: a 4 byte count then first id, tile width and height, columns, margin, spacing and image path for each
+#   tile grid, two bytes per cell (0 is empty, otherwise the tile id), row by row
+#   block table for blocks that don't fit the grid: a 4 byte count then x, y and size for each
+#   hazard table: a 4 byte count then x, y, width, height, x and y velocity and distance for each
+LEVEL_MAGIC = b"GTVL"
+LEVEL_VERSION = 3
+LEVEL_HEADER = struct.Struct("<4sHH32sIIiiiiiiii")
+LEVEL_STRING = struct.Struct("<H")
+LEVEL_COUNT = struct.Struct("<I")
+LEVEL_TILESET = struct.Struct("<IHHHHH")
+LEVEL_BLOCK = struct.Struct("<iiH")
+LEVEL_HAZARD = struct.Struct("<iiHHffI")
+
+
+# function to get the sha256 of a file, used to know if a compiled level is out of date
+def file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).digest()
+
+
+# function to get where the compiled version of a level goes
+# the folder and extension stay in the name, so levels/level1.json and levels/level1.tmx don't share a compiled file
+def compiled_level_path(level_path):
+    name = os.path.normpath(level_path).replace(":", "").replace(os.sep, "_")
+    return join(LEVEL_BUILD_DIR, name + ".lvl")
+
+
+# function to read a level from its json file
+# returns a dict with the name, background, player start, exit rect (or None), blocks as (x, y, size, tile)
+# and hazards as (x, y, width, height, x_vel, y_vel, distance)
+def read_json_level(level_path):
     with open(level_path, "r") as f:
         level_data = json.load(f)
 
-    #set variable names for easier coding
-    level_name = level_data["name"]
-    background = level_data["background"]
-    player_start = level_data["player_start"]
-    # create object lists
     blocks = []
     exit = None
-
+    hazards = []
     for obj_data in level_data["objects"]:
         obj_type = obj_data["type"]
         if obj_type == "block":
-            blocks.append(Block(obj_data["x"], obj_data["y"], obj_data["size"]))
+            blocks.append((obj_data["x"], obj_data["y"], obj_data["size"], TERRAIN_TILE))
         elif obj_type == "exit":
-            exit = Exit(obj_data["x"], obj_data["y"], obj_data["width"], obj_data["height"])
+            # some levels give the exit a single size instead of a width and height
+            width = obj_data.get("width", obj_data.get("size"))
+            height = obj_data.get("height", obj_data.get("size"))
+            exit = (obj_data["x"], obj_data["y"], width, height)
+        elif obj_type == "hazard":
+            width = obj_data.get("width", obj_data.get("size", BLOCK_SIZE))
+            height = obj_data.get("height", obj_data.get("size", BLOCK_SIZE // 2))
+            hazards.append((
+                obj_data["x"], obj_data["y"], width, height,
+                obj_data.get("x_vel", 0), obj_data.get("y_vel", 0), obj_data.get("distance", 0),
+            ))
+
+    return {
+        "name": level_data["name"],
+        "background": level_data["background"],
+        "player_start": level_data["player_start"],
+        "exit": exit,
+        "blocks": blocks,
+        "hazards": hazards,
+    }
+
+
+# function to read a level from a Tiled map
+# the map can have "exit", "player_start" and "hazard" objects and "name" and "background" properties
+def read_tmx_level(level_path):
+    tilemap, objects, hazards, properties = read_tmx_map(level_path)
+    start = objects.get("player_start", objects.get("start", (0, 0)))
+    return {
+        "name": properties.get("name", os.path.splitext(os.path.basename(level_path))[0]),
+        "background": properties.get("background", "Blue.png"),
+        "player_start": {"x": start[0], "y": start[1]},
+        "exit": objects.get("exit") or default_exit(tilemap),
+        "blocks": [],
+        "hazards": hazards,
+        "tilemap": tilemap,
+    }
+
+
+# function to place an exit on top of the rightmost tile when the map doesn't have one
+def default_exit(tilemap):
+    cells = list(tilemap.cells())
+    if not cells:
+        return (WIDTH - BLOCK_SIZE, HEIGHT - BLOCK_SIZE, BLOCK_SIZE, BLOCK_SIZE)
+    x, y, _ = max(cells, key=lambda cell: (cell[0], -cell[1]))
+    return (x, y - BLOCK_SIZE, BLOCK_SIZE, BLOCK_SIZE)
+
+
+# function to read a level source file (json or Tiled map)
+def read_level_source(level_path):
+    if level_path.endswith(".tmx"):
+        return read_tmx_level(level_path)
+    return read_json_level(level_path)
+
+
+# function to put the blocks that line up on a BLOCK_SIZE grid into a tile map
+# returns the tile map and the blocks that didn't fit
+def blocks_to_tilemap(blocks):
+    grid_blocks = [block for block in blocks if block[2] == BLOCK_SIZE and 0 < block[3] <= 0xFFFF]
+    if not grid_blocks:
+        return TileMap(0, 0, BLOCK_SIZE), list(blocks)
+    # the grid starts at the top left block
+    origin_x = min(block[0] for block in grid_blocks)
+    origin_y = min(block[1] for block in grid_blocks)
+    grid_blocks = [
+        block for block in grid_blocks
+        if (block[0] - origin_x) % BLOCK_SIZE == 0 and (block[1] - origin_y) % BLOCK_SIZE == 0
+    ]
+    columns = max(block[0] - origin_x for block in grid_blocks) // BLOCK_SIZE + 1
+    rows = max(block[1] - origin_y for block in grid_blocks) // BLOCK_SIZE + 1
+
+    tilemap = TileMap(columns, rows, BLOCK_SIZE, origin_x, origin_y)
+    for x, y, _, tile in grid_blocks:
+        tilemap.set((x - origin_x) // BLOCK_SIZE, (y - origin_y) // BLOCK_SIZE, tile)
+    in_grid = set(grid_blocks)
+    return tilemap, [block for block in blocks if block not in in_grid]
+
+
+# function to write a level into the compiled format, returns the bytes
+def pack_level(level_data, source_hash):
+    tilemap, other_blocks = blocks_to_tilemap(level_data["blocks"])
+    if level_data.get("tilemap") is not None:
+        # levels from Tiled maps are already a grid
+        tilemap = level_data["tilemap"]
+
+    exit = level_data["exit"] or (0, 0, 0, 0)
+    start = level_data["player_start"]
+    parts = [
+        LEVEL_HEADER.pack(
+            LEVEL_MAGIC, LEVEL_VERSION, tilemap.tile_size, source_hash, tilemap.columns, tilemap.rows,
+            tilemap.origin_x, tilemap.origin_y, start["x"], start["y"], *exit,
+        )
+    ]
+    for text in (level_data["name"], level_data["background"]):
+        parts.append(pack_string(text))
+
+    parts.append(LEVEL_COUNT.pack(len(tilemap.tilesets)))
+    for tileset in tilemap.tilesets:
+        parts.append(LEVEL_TILESET.pack(
+            tileset.first_gid, tileset.tile_width, tileset.tile_height, tileset.columns, tileset.margin, tileset.spacing,
+        ))
+        parts.append(pack_string(tileset.image))
+
+    tiles = array("H", tilemap.tiles)
+    if sys.byteorder == "big":
+        tiles.byteswap()
+    parts.append(tiles.tobytes())
+
+    parts.append(LEVEL_COUNT.pack(len(other_blocks)))
+    for x, y, size, _ in other_blocks:
+        parts.append(LEVEL_BLOCK.pack(x, y, size))
+
+    hazards = level_data.get("hazards", [])
+    parts.append(LEVEL_COUNT.pack(len(hazards)))
+    for x, y, width, height, x_vel, y_vel, distance in hazards:
+        parts.append(LEVEL_HAZARD.pack(x, y, width, height, x_vel, y_vel, round(distance)))
+    return b"".join(parts)
+
+
+# function to pack text as a 2 byte length then utf-8
+def pack_string(text):
+    encoded = text.encode("utf-8")
+    return LEVEL_STRING.pack(len(encoded)) + encoded
+
+
+# function to read text packed with pack_string, returns the text and the position after it
+def unpack_string(view, pos):
+    (length,) = LEVEL_STRING.unpack_from(view, pos)
+    pos += LEVEL_STRING.size
+    return bytes(view[pos:pos + length]).decode("utf-8"), pos + length
+
+
+# function to read a compiled level file, returns the same kind of dict as read_level_source
+def unpack_level(data):
+    view = memoryview(data)
+    (magic, version, tile_size, source_hash, columns, rows, origin_x, origin_y,
+     start_x, start_y, exit_x, exit_y, exit_w, exit_h) = LEVEL_HEADER.unpack_from(view, 0)
+    if magic != LEVEL_MAGIC or version != LEVEL_VERSION:
+        raise ValueError("not a compiled level (or an old version)")
+    pos = LEVEL_HEADER.size
+
+    name, pos = unpack_string(view, pos)
+    background, pos = unpack_string(view, pos)
+
+    (count,) = LEVEL_COUNT.unpack_from(view, pos)
+    pos += LEVEL_COUNT.size
+    tilesets = []
+    for _ in range(count):
+        first_gid, tile_width, tile_height, tileset_columns, margin, spacing = LEVEL_TILESET.unpack_from(view, pos)
+        image, pos = unpack_string(view, pos + LEVEL_TILESET.size)
+        tilesets.append(Tileset(first_gid, image, tile_width, tile_height, tileset_columns, margin, spacing))
+
+    # the grid goes straight from the file data into an array
+    tiles = array("H")
+    tiles.frombytes(view[pos:pos + 2 * columns * rows])
+    if sys.byteorder == "big":
+        tiles.byteswap()
+    pos += 2 * columns * rows
+
+    (count,) = LEVEL_COUNT.unpack_from(view, pos)
+    pos += LEVEL_COUNT.size
+    other_blocks = [(x, y, size, TERRAIN_TILE) for x, y, size in LEVEL_BLOCK.iter_unpack(view[pos:pos + count * LEVEL_BLOCK.size])]
+    pos += count * LEVEL_BLOCK.size
+
+    (count,) = LEVEL_COUNT.unpack_from(view, pos)
+    pos += LEVEL_COUNT.size
+    hazards = list(LEVEL_HAZARD.iter_unpack(view[pos:pos + count * LEVEL_HAZARD.size]))
+
+    return {
+        "name": name,
+        "background": background,
+        "player_start": {"x": start_x, "y": start_y},
+        "exit": (exit_x, exit_y, exit_w, exit_h) if exit_w else None,
+        "blocks": other_blocks,
+        "hazards": hazards,
+        "tilemap": TileMap(columns, rows, tile_size, origin_x, origin_y, tiles, tilesets),
+        "source_hash": source_hash,
+    }
+
+
+# function to read the compiled version of a level if it is up to date with its source, otherwise None
+def read_compiled_level(level_path):
+    compiled_path = compiled_level_path(level_path)
+    if not isfile(compiled_path):
+        return None
+    with open(compiled_path, "rb") as f:
+        data = f.read()
+    try:
+        level_data = unpack_level(data)
+    except (ValueError, struct.error):
+        return None
+    # the source changed since it was compiled, so the compiled level can't be used
+    if isfile(level_path) and file_hash(level_path) != level_data["source_hash"]:
+        return None
+    return level_data
+
+
+# function to compile one level, skipped if the compiled level is already up to date
+# returns True if the level was compiled
+def compile_level(level_path, force=False):
+    source_hash = file_hash(level_path)
+    compiled_path = compiled_level_path(level_path)
+    if not force and isfile(compiled_path):
+        with open(compiled_path, "rb") as f:
+            header = f.read(LEVEL_HEADER.size)
+        if len(header) == LEVEL_HEADER.size:
+            magic, version, _, old_hash = LEVEL_HEADER.unpack(header)[:4]
+            if magic == LEVEL_MAGIC and version == LEVEL_VERSION and old_hash == source_hash:
+                return False
+
+    data = pack_level(read_level_source(level_path), source_hash)
+    os.makedirs(LEVEL_BUILD_DIR, exist_ok=True)
+    with open(compiled_path, "wb") as f:
+        f.write(data)
+    return True
+
+
+# function to compile every level and Tiled map, returns the paths that were compiled
+def compile_levels(level_paths=None, force=False):
+    if level_paths is None:
+        level_paths = sorted(glob(join("levels", "*.json")) + glob(join("levels", "*.tmx"))) + sorted(glob(join("Tiled", "*.tmx")))
+    return [level_path for level_path in level_paths if compile_level(level_path, force)]
+
+
+# function to get the path of a level by its index, levels can be json files or Tiled maps
+def find_level(level_index):
+    for extension in (".json", ".tmx"):
+        level_path = join("levels", f"level{level_index + 1}{extension}")
+        if isfile(level_path):
+            return level_path
+    # if there is no source the compiled level may still be there, otherwise loading it fails
+    return join("levels", f"level{level_index + 1}.json")
+
+
+# function to read a level file into a dict, without making any surfaces (so it can run on another thread)
+def read_level_data(level_path):
+    # use the compiled level if it is up to date, otherwise read the source
+    return read_compiled_level(level_path) or read_level_source(level_path)
+
+
+def load_level(level_path):
+    return build_level(read_level_data(level_path))
+
+
+# function to make the level (blocks, collisions...) from the dict read by read_level_data
+# this makes surfaces, so it has to run on the main thread
+# streaming is None to stream only levels with more than STREAMING_MIN_TILES tiles
+def build_level(level_data, streaming=None):
+    #set variable names for easier coding
+    level_name = level_data["name"]
+    background = level_data["background"]
+    player_start = level_data["player_start"]
+    block_data = level_data["blocks"]
+    tilemap = level_data.get("tilemap")  # tiles stay in their grid instead of becoming blocks
+    if streaming is None:
+        tile_count = len(block_data) + (tilemap.count() if tilemap is not None else 0)
+        streaming = tile_count > STREAMING_MIN_TILES
+    if streaming and tilemap is None:
+        # streamed levels need their blocks in a grid
+        tilemap, block_data = blocks_to_tilemap(block_data)
+    # create object lists
+    blocks = BlockArray(block_data)
+    if streaming and blocks:
+        streaming = False  # blocks that don't fit the grid can't be streamed
+    exit = None
+    if level_data["exit"]:
+        exit = Exit(*level_data["exit"])
+
+    # rects of everything solid in the level
+    rects = []
+    block_bounds = blocks.bounds()
+    if block_bounds is not None:
+        rects.append(block_bounds)
+    tile_bounds = tilemap.bounds() if tilemap is not None else None
+    if tile_bounds is not None:
+        rects.append(tile_bounds)
 
     level_width = 0
     level_height = 0
-    if blocks:
-        min_x = min([block.rect.left for block in blocks])
-        max_x = max([block.rect.right for block in blocks])
-        min_y = min([block.rect.top for block in blocks])
-        max_y = max([block.rect.bottom for block in blocks])
+    if rects:
+        min_x = min([rect.left for rect in rects])
+        max_x = max([rect.right for rect in rects])
+        min_y = min([rect.top for rect in rects])
+        max_y = max([rect.bottom for rect in rects])
         level_width = max_x - min_x
         level_height = max_y - min_y
     else:
         level_height = HEIGHT  # set to the height of the screen if there are no blocks
         level_width = WIDTH
 
-    return level(level_name, background, blocks, exit, player_start), level_width, level_height
+    hazards = level_data.get("hazards", [])
+
+    return level(level_name, background, blocks, exit, player_start, tilemap, streaming, hazards), level_width, level_height
+
+
+# class for a level being read in the background by a LevelPrefetcher
+class PrefetchJob:
+    def __init__(self, level_index):
+        self.level_index = level_index
+        self.level_data = None  # the level read by the thread
+        self.error = None  # error raised while reading (e.g. FileNotFoundError when there are no more levels)
+        self.done = threading.Event()
+        self.result = None  # the built level, from load_level
+        self.steps = None  # the LevelPrefetcher.build generator making the level's surfaces
+
+    # method run on the worker thread to read the level file
+    def read(self):
+        try:
+            self.level_data = read_level_data(find_level(self.level_index))
+        except Exception as error:
+            self.error = error
+        self.done.set()
+
+
+# class that reads the next level on a worker thread while the current one is played
+# the file reading and decoding happen on the thread, the surfaces are made on the main thread
+class LevelPrefetcher:
+    def __init__(self):
+        self.job = None
+
+    # method to start reading a level in the background (does nothing if it is already being read)
+    def start(self, level_index):
+        if self.job is not None and self.job.level_index == level_index and self.job.error is None:
+            return
+        self.job = PrefetchJob(level_index)
+        threading.Thread(target=self.job.read, daemon=True).start()
+
+    # method called every frame, builds the level a little at a time once the thread is done so switching is instant
+    # stops after the step that goes past budget seconds, so building the level never takes a whole frame
+    def poll(self, budget=PREFETCH_BUDGET):
+        job = self.job
+        if job is None or not job.done.is_set() or job.error is not None:
+            return
+        if job.steps is None:
+            job.steps = self.build(job)
+        deadline = time.perf_counter() + budget
+        for _ in job.steps:
+            if time.perf_counter() >= deadline:
+                break
+
+    # generator making the surfaces of a read level on the main thread, one step at a time
+    # the level can be taken once its terrain is queued, the chunks not baked by then are baked when first seen
+    def build(self, job):
+        result = build_level(job.level_data)
+        yield
+        current_level = result[0]
+        asset_cache.load_image(join("assets", "Background", current_level.background))
+        yield
+        get_background(current_level.background)
+        yield
+        terrain = current_level.terrain
+        job.result = result
+        if not current_level.streaming:
+            while terrain.bake_next():
+                yield
+
+    # method to run the build steps of a job until its level can be taken
+    def finish(self, job):
+        if job.steps is None:
+            job.steps = self.build(job)
+        while job.result is None:
+            next(job.steps)
+
+    # method to get a level, from the prefetch if it has it, otherwise it is loaded now
+    # shows a loading screen on the window if it has to wait for the thread
+    def take(self, level_index, window=None):
+        job = self.job
+        if job is None or job.level_index != level_index:
+            return load_level(find_level(level_index))
+        if not job.done.is_set():
+            if window is not None:
+                draw_loading(window)
+                pygame.display.update()
+            job.done.wait()
+        if job.error is not None:
+            self.job = None
+            raise job.error
+        if job.result is None:
+            self.finish(job)
+        return job.result
+
+
+# function to create the players at the start of a level
+def create_players(current_level, num_players):
+    players = []
+    for i, (character_name, sprite_width, sprite_height) in enumerate(CHARACTERS[:num_players]):
+        players.append(
+            Player(
+                current_level.player_start["x"] + 100 * i,
+                current_level.player_start["y"],
+                PLAYER_WIDTH,
+                PLAYER_HEIGHT,
+                "MainCharacters",
+                character_name,
+                sprite_width,
+                sprite_height,
+            )
+        )
+    return players
+
+
+# function to check for players falling off the map, and if so decrease lives
+# now is the time in milliseconds (the real clock in the game, the tick count in simulations)
+def check_falls(players, lives, now):
+    for player in players:
+        if not player.on_ground and player.rect.top > (FALL_THRESHOLD):
+            if now - player.last_hit_time > 1000:
+                player.jump()
+                lives -= 1
+    return lives
+
+
+# function to check if every player made it to the exit
+def players_at_exit(players, exit):
+    return all(exit.rect.collidepoint(player.rect.center) for player in players)
+
+
+# letters used in input scripts for each action
+ACTION_LETTERS = {"l": "left", "r": "right", "j": "jump"}
+
+
+# class that acts like pygame.key.get_pressed() for scripted input
+class ScriptedKeys:
+    def __init__(self, pressed=()):
+        self.pressed = set(pressed)
+
+    def __getitem__(self, key):
+        return key in self.pressed
+
+
+# function to turn one tick of an input script into pressed keys
+# actions has a string per player with the letters of the actions held, e.g. ["r", "lj"]
+def script_keys(actions):
+    pressed = set()
+    for bindings, letters in zip(PLAYER_BINDINGS, actions):
+        for letter in letters:
+            pressed.add(bindings[ACTION_LETTERS[letter]])
+    return ScriptedKeys(pressed)
+
+
+# class that runs the game physics for one level without drawing anything
+# every tick is simulated exactly the same way every time, so a script always gives the same result
+# with a level index it goes on to the next level at each exit like the game does, instead of stopping
+class Simulation:
+    def __init__(self, level_path, num_players=2, level_index=None):
+        self.level_path = level_path
+        self.level_index = level_index
+        self.level, self.level_width, self.level_height = load_level(level_path)
+        self.players = create_players(self.level, num_players)
+        self.hazards = HazardPool()
+        self.hazards.load(self.level.hazards)
+        self.lives = num_players + 1
+        self.ticks = 0
+        self.reached_exit = False
+        self.won = False  # every level was finished (only when going through the levels)
+
+    # method to check if the simulation is over (level finished or out of lives)
+    def finished(self):
+        if self.level_index is not None:
+            return self.won or self.lives <= 0
+        return self.reached_exit or self.lives <= 0
+
+    # method to go on to the next level, the same way the game does when every player is at the exit
+    def next_level(self):
+        try:
+            next_path = find_level(self.level_index + 1)
+            self.level, self.level_width, self.level_height = load_level(next_path)
+        except FileNotFoundError:
+            self.won = True
+            return
+        self.level_index += 1
+        self.level_path = next_path
+        self.hazards.load(self.level.hazards)
+        for player in self.players:
+            player.rect.x = self.level.player_start["x"]
+            player.rect.y = self.level.player_start["y"]
+            player.reset_previous_position()
+        self.reached_exit = False
+
+    # method to run one physics tick with the given keys
+    def step(self, keys):
+        for player in self.players:
+            player.loop(FPS)
+        self.hazards.update()
+        handle_move(self.players, self.level.grid, keys)
+        now = self.ticks * 1000 // FPS
+        self.lives = self.hazards.resolve_damage(self.players, self.lives, now)
+        self.lives = check_falls(self.players, self.lives, now)
+        self.ticks += 1
+        self.reached_exit = players_at_exit(self.players, self.level.exit)
+        if self.reached_exit and self.level_index is not None:
+            self.next_level()
+
+    # method to run a whole input script, stops early if the simulation finishes
+    def run(self, script):
+        start = time.perf_counter()
+        for actions in script:
+            self.step(script_keys(actions))
+            if self.finished():
+                break
+        result = self.summary()
+        result["seconds"] = time.perf_counter() - start
+        return result
+
+    # method to get the results of the simulation
+    def summary(self):
+        return {
+            "level": self.level_path,
+            "ticks": self.ticks,
+            "lives": self.lives,
+            "reached_exit": self.reached_exit or self.won,
+            "positions": [[player.rect.x, player.rect.y] for player in self.players],
+        }
+
+
+# function to make a random input script, the seed makes it the same every time
+def random_script(ticks, num_players, seed):
+    rng = random.Random(seed)
+    script = []
+    actions = [""] * num_players
+    for _ in range(ticks):
+        # every so often each player picks new keys to hold
+        actions = [rng.choice(["", "r", "r", "rj", "l", "lj", "j"]) if rng.random() < 0.05 else held for held in actions]
+        script.append(list(actions))
+    return script
+
+
+# function to run one simulation job in a worker process
+def run_script(job):
+    level_path, num_players, script = job
+    return Simulation(level_path, num_players).run(script)
+
+
+# function to replay many input scripts on many levels at once using a pool of processes
+def run_batch(scripts, level_paths=None, num_players=2, processes=None):
+    if level_paths is None:
+        level_paths = sorted(glob(join("levels", "*.json")))
+    jobs = [(level_path, num_players, script) for level_path in level_paths for script in scripts]
+    pool = multiprocessing.Pool(processes, initializer=init_headless)
+    try:
+        return pool.map(run_script, jobs)
+    finally:
+        # let the workers exit on their own, SDL catches the signal Pool.terminate() sends
+        pool.close()
+        pool.join()
+
+
+# player actions saved in replays, one bit each per player
+INPUT_ACTIONS = ("left", "right", "jump")
+# bit of every key in PLAYER_BINDINGS, player 1 uses the lowest bits
+KEY_BITS = {
+    bindings[action]: 1 << (i * len(INPUT_ACTIONS) + bit)
+    for i, bindings in enumerate(PLAYER_BINDINGS)
+    for bit, action in enumerate(INPUT_ACTIONS)
+}
+
+
+# function to pack the keys every player is holding into one number, a bit per player action
+def pack_input(keys):
+    bits = 0
+    for key, bit in KEY_BITS.items():
+        if keys[key]:
+            bits |= bit
+    return bits
+
+
+# class that acts like pygame.key.get_pressed() for input packed with pack_input
+class PackedKeys:
+    def __init__(self, bits=0):
+        self.bits = bits
+
+    def __getitem__(self, key):
+        return bool(self.bits & KEY_BITS.get(key, 0))
+
+
+# replay file format (little endian): magic, version, ticks per second, number of players, first level index,
+# number of ticks, then the packed input of every tick (2 bytes each) compressed with zlib
+REPLAY_MAGIC = b"GTVR"
+REPLAY_VERSION = 1
+REPLAY_HEADER = struct.Struct("<4sHHHHI")
+
+
+# class for the input of one run of the game, a packed number per physics tick
+# the physics only depends on this input, so playing it back gives the same run every time
+class Replay:
+    def __init__(self, level_index=0, num_players=1, inputs=None):
+        self.level_index = level_index  # level the run started on
+        self.num_players = num_players
+        self.inputs = inputs if inputs is not None else array("H")
+
+    # method to add the keys of one tick, returns the keys as recorded so the game uses exactly what is saved
+    def record(self, keys):
+        bits = pack_input(keys)
+        self.inputs.append(bits)
+        return PackedKeys(bits)
+
+    # method to get the keys of a tick
+    def keys(self, tick):
+        return PackedKeys(self.inputs[tick])
+
+    def __len__(self):
+        return len(self.inputs)
+
+    # method to write the replay to a file
+    def save(self, path):
+        inputs = array("H", self.inputs)
+        if sys.byteorder == "big":
+            inputs.byteswap()
+        with open(path, "wb") as f:
+            f.write(REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, FPS, self.num_players, self.level_index, len(inputs)))
+            f.write(zlib.compress(inputs.tobytes(), 9))
+
+
+# function to read a replay written by Replay.save
+def read_replay(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version, fps, num_players, level_index, ticks = REPLAY_HEADER.unpack_from(data, 0)
+    if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+        raise ValueError(f"{path}: not a replay (or an old version)")
+    if fps != FPS:
+        raise ValueError(f"{path}: recorded at {fps} ticks per second, the game runs at {FPS}")
+    inputs = array("H")
+    inputs.frombytes(zlib.decompress(data[REPLAY_HEADER.size:]))
+    if sys.byteorder == "big":
+        inputs.byteswap()
+    if len(inputs) != ticks:
+        raise ValueError(f"{path}: replay is cut short")
+    return Replay(level_index, num_players, inputs)
+
+
+# function to play a replay as fast as possible without drawing anything, going through the levels like the game
+def fast_forward(replay):
+    start = time.perf_counter()
+    simulation = Simulation(find_level(replay.level_index), replay.num_players, replay.level_index)
+    for tick in range(len(replay)):
+        simulation.step(replay.keys(tick))
+        if simulation.finished():
+            break
+    result = simulation.summary()
+    result["seconds"] = time.perf_counter() - start
+    result["ticks_per_second"] = simulation.ticks / max(result["seconds"], 1e-9)
+    return result
+
+
+# function to make a level with a given number of blocks for benchmarks
+# a long floor with platforms above it, the seed makes it the same every time
+def make_stress_level(num_blocks, seed=0):
+    rng = random.Random(seed)
+    floor_length = max(WIDTH // BLOCK_SIZE, num_blocks // 4)
+    floor_y = HEIGHT - BLOCK_SIZE
+    cells = [(column, 0) for column in range(min(num_blocks, floor_length))]
+    taken = set(cells)
+    # the rest of the blocks go on rows of platforms, leaving room to jump between them
+    while len(cells) < num_blocks:
+        cell = (rng.randrange(floor_length), rng.randrange(2, 24, 2))
+        if cell not in taken:
+            taken.add(cell)
+            cells.append(cell)
+    return {
+        "name": f"Stress {num_blocks}",
+        "background": "Blue.png",
+        "player_start": {"x": 0, "y": floor_y - BLOCK_SIZE},
+        "objects": [{"type": "block", "x": column * BLOCK_SIZE, "y": floor_y - row * BLOCK_SIZE, "size": BLOCK_SIZE} for column, row in cells]
+        + [{"type": "exit", "x": (floor_length - 1) * BLOCK_SIZE, "y": floor_y - BLOCK_SIZE, "width": BLOCK_SIZE, "height": BLOCK_SIZE}],
+    }
+
+
+# function to time a function, returns the best average time of one call (in seconds) over a few rounds
+# each round makes at least calls calls, more if they are too fast to fill BENCHMARK_ROUND_SECONDS
+def time_calls(function, calls=1, rounds=BENCHMARK_ROUNDS):
+    timer = timeit.Timer(function)
+    while timer.timeit(calls) < BENCHMARK_ROUND_SECONDS:
+        calls *= 2
+    return min(timer.repeat(rounds, calls)) / calls
+
+
+# function to time slow calls one at a time, returns the median seconds per call
+# one slow call can't be repeated enough to average out, the median ignores the odd call hit by a hiccup
+def time_median(function, calls=BENCHMARK_REPEATS):
+    times = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+# function to benchmark one level with a number of players
+# times are in microseconds, per tick for all the players
+def benchmark_level(window, level_path, num_players, calls=100, frames=10):
+    current_level, level_width, level_height = load_level(level_path)
+    players = create_players(current_level, num_players)
+    lives = num_players + 1
+    background, bg_image = get_background(current_level.background)
+    cameras = CameraRig()
+    cameras.setup(num_players)
+
+    # keep the chunks around the camera and the players loaded (for streamed levels)
+    def stream():
+        cameras.follow(players, level_width, level_height, snap=True)
+        current_level.stream(cameras.views() + [player.rect for player in players])
+
+    # play a few ticks so the players are standing or falling somewhere in the level
+    for actions in random_script(BENCHMARK_TICKS, num_players, seed=0):
+        stream()
+        for player in players:
+            player.loop(FPS)
+        handle_move(players, current_level.grid, script_keys(actions))
+    stream()
+
+    objects = current_level.grid
+    dys = [player.y_vel for player in players]
+    # draw once so the terrain chunks are made before timing
+    terrain = [current_level.terrain]
+    draw(window, background, bg_image, players, terrain, current_level.exit, 0, 0, lives, GAME, 1, cameras)
+
+    # moves each player and puts them back, so every call starts from the same place
+    def tick_move():
+        for player, dy in zip(players, dys):
+            x, y = player.rect.topleft
+            move_and_collide(player, objects, PLAYER_VEL, dy)
+            player.rect.topleft = (x, y)
+
+    def tick_ground():
+        for player in players:
+            is_on_ground(player, objects)
+
+    def tick_update():
+        for player in players:
+            player.update()
+
+    def frame():
+        stream()
+        draw(window, background, bg_image, players, terrain, current_level.exit, 0, 0, lives, GAME, 1, cameras)
+
+    # a frame with every camera mode, the scaled chunks are made by a first frame before timing
+    frame_times = {}
+    for mode in CAMERA_MODES:
+        cameras.mode = mode
+        cameras.setup(num_players)
+        frame()
+        frame_times[mode] = time_calls(frame, frames) * 1000
+
+    # the player one camera again, with the world drawn at the low resolution and scaled up
+    cameras.mode = CAMERA_MODES[0]
+    cameras.setup(num_players)
+    scale = render_target.scale
+    render_target.scale = LOW_RES_SCALE
+    frame()
+    frame_times["low_res"] = time_calls(frame, frames) * 1000
+    render_target.scale = scale
+
+    result = {
+        "case": f"{os.path.splitext(os.path.basename(level_path))[0]}/{num_players}p",
+        "level": os.path.basename(level_path),
+        "players": num_players,
+        "streaming": current_level.streaming,
+        "collision_rects": len(current_level.collision),
+        "collision_saved": current_level.collision_saved,  # blocks and tiles merged away, to check merging still works
+        "move_and_collide_us": time_calls(tick_move, calls) * 1000000,
+        "is_on_ground_us": time_calls(tick_ground, calls) * 1000000,
+        "player_update_us": time_calls(tick_update, calls) * 1000000,
+        "draw_frame_ms": frame_times["follow"],
+        "draw_group_ms": frame_times["group"],
+        "draw_split_ms": frame_times["split"],
+        "draw_low_res_ms": frame_times["low_res"],
+    }
+    # memory of the loaded chunks of a streamed level, their scaled copies included, to check they stay in the budget
+    if current_level.streaming:
+        result["streamed_mb"] = current_level.world.total_bytes / (1024 * 1024)
+    return result
+
+
+# function to benchmark the batched entity physics with a number of entities spread over a level
+# step_ms is the time of one 60 Hz tick for all of them
+def benchmark_entities(level_path, num_entities, ticks=10):
+    current_level, level_width, level_height = load_level(level_path)
+    physics = EntityPhysics(num_entities)
+    physics.set_level(current_level)
+    rng = random.Random(0)
+    for _ in range(num_entities):
+        physics.add(rng.uniform(0, level_width), rng.uniform(-level_height, HEIGHT - BLOCK_SIZE), 32, 32, rng.choice((-2, 2)))
+    # let the entities fall and land first so both falling and walking are timed
+    for _ in range(BENCHMARK_TICKS):
+        physics.step()
+    return {
+        "case": f"entities/{os.path.splitext(os.path.basename(level_path))[0]}/{num_entities}",
+        "level": os.path.basename(level_path),
+        "entities": num_entities,
+        "step_ms": time_calls(physics.step, ticks) * 1000,
+    }
+
+
+# function to benchmark the hazard pool with a number of moving hazards around the players
+# update_us is moving every hazard for one tick, damage_us is checking every player against every hazard
+def benchmark_hazards(level_path, num_hazards, num_players=4, calls=100):
+    current_level, level_width, level_height = load_level(level_path)
+    players = create_players(current_level, num_players)
+    hazards = HazardPool()
+    rng = random.Random(0)
+    for _ in range(num_hazards):
+        # packed around the start so the players overlap some of them
+        hazards.spawn(
+            current_level.player_start["x"] + rng.randrange(-WIDTH, WIDTH), current_level.player_start["y"] + rng.randrange(-HEIGHT // 2, HEIGHT // 2),
+            BLOCK_SIZE // 2, BLOCK_SIZE // 4, rng.choice((-2, 0, 2)), rng.choice((-1, 0, 1)), rng.randrange(0, 300),
+        )
+    return {
+        "case": f"hazards/{os.path.splitext(os.path.basename(level_path))[0]}/{num_hazards}",
+        "level": os.path.basename(level_path),
+        "hazards": num_hazards,
+        "players": num_players,
+        "update_us": time_calls(hazards.update, calls) * 1000000,
+        "damage_us": time_calls(lambda: hazards.resolve_damage(players, 10, 0), calls) * 1000000,
+    }
+
+
+# function to run the benchmarks on the shipped levels and generated stress levels
+# returns a dict that can be saved as json and used as a baseline later
+def run_benchmarks(block_counts=BENCHMARK_BLOCKS, player_counts=BENCHMARK_PLAYERS, level_paths=None, entity_counts=BENCHMARK_ENTITIES, hazard_counts=BENCHMARK_HAZARDS):
+    window = init_headless((WIDTH, HEIGHT))
+    pygame.font.init()
+    if level_paths is None:
+        level_paths = sorted(glob(join("levels", "level*.json")) + glob(join("levels", "level*.tmx")))
+
+    cases = []
+    with tempfile.TemporaryDirectory() as folder:
+        # packing the texture atlas from the sprite sheets, and loading it back once it was saved
+        atlas_folder = join(folder, "atlas")
+        cases.append({
+            "case": "atlas",
+            "pack_ms": time_median(lambda: load_texture_atlas(None)) * 1000,
+            "save_ms": time_median(lambda: texture_atlas.save(atlas_folder, {path: file_hash(path).hex() for path in atlas_source_files()})) * 1000,
+            "load_ms": time_median(lambda: load_texture_atlas(atlas_folder)) * 1000,
+            "images": len(texture_atlas),
+            "pages": len(texture_atlas.pages),
+        })
+
+        # the stress levels are written as json files so loading them is timed like a real level
+        stress_paths = []
+        for num_blocks in block_counts:
+            stress_path = join(folder, f"stress{num_blocks}.json")
+            with open(stress_path, "w") as f:
+                json.dump(make_stress_level(num_blocks), f)
+            stress_paths.append(stress_path)
+
+        for level_path in level_paths + stress_paths:
+            # loading is timed once per level, it doesn't depend on the players
+            cases.append({
+                "case": f"load/{os.path.splitext(os.path.basename(level_path))[0]}",
+                "level": os.path.basename(level_path),
+                "load_level_ms": time_median(lambda: load_level(level_path)) * 1000,
+            })
+            for num_players in player_counts:
+                cases.append(benchmark_level(window, level_path, num_players))
+
+        for num_hazards in hazard_counts:
+            cases.append(benchmark_hazards(level_paths[0], num_hazards))
+
+        # the entity physics is only benchmarked when numpy is installed
+        if numpy is not None:
+            entity_level = stress_paths[0] if stress_paths else level_paths[0]
+            for num_entities in entity_counts:
+                cases.append(benchmark_entities(entity_level, num_entities))
+
+    return {
+        "python": platform.python_version(),
+        "pygame": pygame.version.ver,
+        "numpy": numpy.__version__ if numpy is not None else None,
+        "machine": platform.machine(),
+        "cases": cases,
+    }
+
+
+# function to compare benchmark results with a baseline
+# returns a line for every time that got slower than the tolerance allows, and by at least BENCHMARK_MIN_DELTA
+def compare_benchmarks(results, baseline, tolerance=BENCHMARK_TOLERANCE):
+    regressions = []
+    baseline_cases = {case["case"]: case for case in baseline["cases"]}
+    for case in results["cases"]:
+        old_case = baseline_cases.get(case["case"])
+        if old_case is None:
+            continue
+        for metric, value in case.items():
+            old_value = old_case.get(metric)
+            unit = metric[-3:]
+            if unit not in BENCHMARK_MIN_DELTA or not old_value:
+                continue
+            if value > old_value * (1 + tolerance) and value - old_value >= BENCHMARK_MIN_DELTA[unit]:
+                regressions.append(f"{case['case']} {metric}: {old_value:.2f} -> {value:.2f} ({value / old_value - 1:+.0%})")
+    return regressions
+
+
+# class for a saved copy of the game state, quick to make and to put back
+# the level is kept as the loaded level object, so going back to it doesn't read anything from disk
+class Snapshot:
+    def __init__(self, level_data, lives, game_ticks, cameras, players, hazards):
+        self.level_data = level_data  # (level, level width, level height, level index)
+        self.lives = lives
+        self.game_ticks = game_ticks
+        self.cameras = cameras  # CameraRig.snapshot()
+        self.players = players  # Player.snapshot() of each player
+        self.hazards = hazards  # HazardPool.snapshot()
+
+
+# function to save the state of the game
+def take_snapshot(level_data, players, hazards, lives, game_ticks, cameras):
+    return Snapshot(level_data, lives, game_ticks, cameras.snapshot(), tuple(player.snapshot() for player in players), hazards.snapshot())
+
+
+# function to put the players and hazards back as they were in a snapshot
+# the rest (lives, level, camera...) is read from the snapshot by the game
+def restore_snapshot(snapshot, players, hazards):
+    for player, state in zip(players, snapshot.players):
+        player.restore(state)
+    hazards.restore(snapshot.hazards)
+
+
+# class for the recent states of the game, the oldest are dropped once it is full
+class SnapshotHistory:
+    def __init__(self, capacity=REWIND_SECONDS * FPS // REWIND_INTERVAL):
+        self.snapshots = deque(maxlen=capacity)
+
+    # method to save a state, dropping the oldest if there are too many
+    def push(self, snapshot):
+        self.snapshots.append(snapshot)
+
+    # method to take back the most recent state, or None if there are none left
+    def pop(self):
+        return self.snapshots.pop() if self.snapshots else None
+
+    # method to forget every state
+    def clear(self):
+        self.snapshots.clear()
+
+    def __len__(self):
+        return len(self.snapshots)
 
 
 # main function of the game
-def main(window):
+# record_path saves the input of each run to a replay file, replay plays a recorded run back instead of reading the keyboard
+# camera_mode is the camera the game starts with (one of CAMERA_MODES)
+# atlas_folder is where the texture atlas is saved and loaded from (None packs it every time)
+def main(window, record_path=None, replay=None, camera_mode=CAMERA_MODES[0], atlas_folder=ATLAS_BUILD_DIR):
     # create clock to control frame rate
     clock = pygame.time.Clock()
-    # get the current lvl
-    current_level_index = 0
+    # pack the character frames and terrain tiles into the texture atlas (or load the saved one)
+    load_texture_atlas(atlas_folder)
+    # get the current lvl (a replay starts on the level it was recorded on)
+    current_level_index = replay.level_index if replay is not None else 0
     # load the first lvl
-    current_level, level_width, level_height = load_level(f"levels/level{current_level_index + 1}.json")  # load lvl 1
+    current_level, level_width, level_height = load_level(find_level(current_level_index))  # load lvl 1
     # store current lvl
     current_level_data = (current_level, level_width, level_height, current_level_index)
+    # reads the next level in the background while this one is played
+    prefetcher = LevelPrefetcher()
+    # hazards of the current level, reused from level to level
+    hazards = HazardPool()
 
     # get background tiles and image
     background, bg_image = get_background(current_level.background)
@@ -595,158 +3410,235 @@ def main(window):
     players = []
     lives = 0
     objects = []
-    offset_x = 0
-    offset_y = 0
+    collision_grid = SpatialGrid([])  # collision rectangles of the current level
+    cameras = CameraRig(camera_mode)
     exit = None # Added default exit variable
+    game_ticks = 0  # physics ticks since the run started, the game clock for damage and falls
+    recording = None  # input of the current run, saved to record_path when the run ends
+    checkpoint = None  # state at the start of the current level, for restarting it
+    history = SnapshotHistory()  # recent states, for rewinding (hold backspace)
+    restore_to = None  # state to go back to at the start of the next frame
 
     menu_boxes = []
 
     # main game loop
     run = True
     initial_offset = True  # cue for intial offset
+    accumulator = 0  # time not yet simulated, in seconds
     while run:
-        clock.tick(FPS)
+        # draw as fast as allowed while playing, other screens don't need more than FPS
+        frame_time = clock.tick(MAX_FPS if game_state == GAME else FPS) / 1000
+        profiler.next_frame()
 
+        num_players_selected = 0
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 # quit game if window closed
                 run = False
                 break
+            if event.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED, pygame.WINDOWSIZECHANGED):
+                # the window was covered, restored or resized, draw everything again
+                screen_updater.invalidate()
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                # F3 turns the profiler and its overlay on and off
+                profiler.toggle()
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_F4 and profiler.enabled:
+                # F4 saves what the profiler recorded as a trace
+                profiler.export(PROFILE_TRACE_PATH)
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_F2:
+                # F2 switches between following player one, the group camera and split screen
+                cameras.next_mode(num_players)
+                initial_offset = True
             if game_state == MENU:
-                num_players_selected = handle_menu_input(event, menu_boxes)
-                if num_players_selected:
-                    game_state = GAME
-                    num_players = num_players_selected
-                    lives = num_players + 1
-                    # create a list of players
-                    #MAKE SURE DIMENSIONS ARE ACCURATE WITH SPRITE SHEET
-                    players = [
-                        Player(
-                            current_level.player_start["x"],
-                            current_level.player_start["y"],
-                            PLAYER_WIDTH,
-                            PLAYER_HEIGHT,
-                            "MainCharacters",
-                            "p1Njal",
-                            12,
-                            45,
-                        ),
-                        Player(
-                            current_level.player_start["x"] + 100,
-                            current_level.player_start["y"],
-                            PLAYER_WIDTH,
-                            PLAYER_HEIGHT,
-                            "MainCharacters",
-                            "p2Revna",
-                            15,
-                            42,
-                        ),
-                    ]
-                    if num_players >= 3:
-                        players.append(
-                            Player(
-                                current_level.player_start["x"] + 200,
-                                current_level.player_start["y"],
-                                PLAYER_WIDTH,
-                                PLAYER_HEIGHT,
-                                "MainCharacters",
-                                "p3Dwalin",
-                                13,
-                                35,
-                            )
-                        )
-                    if num_players == 4:
-                        players.append(
-                            Player(
-                                current_level.player_start["x"] + 300,
-                                current_level.player_start["y"],
-                                PLAYER_WIDTH,
-                                PLAYER_HEIGHT,
-                                "MainCharacters",
-                                "p4Bjorn",
-                                10,
-                                43,
-                            )
-                        )
-                    objects = current_level.blocks
-                    exit = current_level.exit #separate exit
-
-                    initial_offset = True
+                num_players_selected = handle_menu_input(event, menu_boxes) or num_players_selected
+
+        # a replay starts right away with the players it was recorded with
+        if game_state == MENU and replay is not None and run:
+            num_players_selected = replay.num_players
+
+        if game_state == MENU and num_players_selected:
+            game_state = GAME
+            num_players = num_players_selected
+            lives = num_players + 1
+            # create a list of players
+            players = create_players(current_level, num_players)
+            hazards.load(current_level.hazards)
+            objects = [current_level.terrain, hazards]  # the pre-drawn level terrain and the hazards
+            collision_grid = current_level.grid
+            exit = current_level.exit #separate exit
+            cameras.setup(num_players)
+
+            initial_offset = True
+            accumulator = 0  # start simulating from now
+            game_ticks = 0
+            if record_path:
+                recording = Replay(current_level_index, num_players)
+            checkpoint = take_snapshot(current_level_data, players, hazards, lives, game_ticks, cameras)
+            history.clear()
+            # start reading the next level right away
+            prefetcher.start(current_level_index + 1)
+
+        # holding backspace rewinds the game (not while playing a replay)
+        rewinding = game_state == GAME and replay is None and pygame.key.get_pressed()[pygame.K_BACKSPACE]
+        if rewinding:
+            restore_to = history.pop() or restore_to
+
+        # go back to a saved state (restarting the level or rewinding), nothing is loaded again
+        if restore_to is not None:
+            if restore_to.level_data[0] is not current_level:
+                current_level_data = restore_to.level_data
+                current_level, level_width, level_height, current_level_index = current_level_data
+                background, bg_image = get_background(current_level.background)
+                objects = [current_level.terrain, hazards]  # the pre-drawn level terrain and the hazards
+                collision_grid = current_level.grid
+                exit = current_level.exit
+                prefetcher.start(current_level_index + 1)
+            restore_snapshot(restore_to, players, hazards)
+            lives = restore_to.lives
+            game_ticks = restore_to.game_ticks
+            cameras.restore(restore_to.cameras)
+            initial_offset = True
+            accumulator = 0
+            game_state = GAME
+            restore_to = None
+            # the run doesn't follow the recorded input any more, so the recording stops here
+            if recording is not None:
+                recording.save(record_path)
+                recording = None
 
         if game_state == GAME:
-            # update each player
-            for player in players:
-                player.loop(FPS)
-
-            # handle player movement
-            lives = handle_move(players, objects, lives)
-
-            # check for initial offset and update the offset if true
-            if initial_offset:
-                offset_x, offset_y = camera_follow(
-                    players[0], offset_x, offset_y, level_width, level_height
-                )
+            # finish the next level once the background thread has read it
+            with profiler.scope("prefetch"):
+                prefetcher.poll()
+            # keep the chunks around the camera and the players loaded (for streamed levels)
+            with profiler.scope("stream"):
+                current_level.stream(cameras.views() + [player.rect for player in players])
+
+            # add the time since the last frame and run as many fixed ticks as fit into it
+            accumulator += frame_time
+            steps = 0
+            while game_state == GAME and not rewinding and accumulator >= TICK_TIME and steps < MAX_CATCH_UP_STEPS:
+                accumulator -= TICK_TIME
+                steps += 1
+
+                # update each player
+                with profiler.scope("Player.loop"):
+                    for player in players:
+                        player.loop(FPS)
+
+                # move the hazards
+                with profiler.scope("hazards"):
+                    hazards.update()
+
+                # read the keys for this tick, from the replay when playing one back
+                if replay is not None:
+                    if game_ticks >= len(replay):
+                        run = False  # the replay is over
+                        break
+                    keys = replay.keys(game_ticks)
+                else:
+                    keys = pygame.key.get_pressed()
+                    if recording is not None:
+                        keys = recording.record(keys)
+
+                # handle player movement
+                with profiler.scope("handle_move"):
+                    handle_move(players, collision_grid, keys)
+
+                # hurt the players touching a hazard (the clock is the tick count, so replays give the same result)
+                now = game_ticks * 1000 // FPS
+                with profiler.scope("damage"):
+                    lives = hazards.resolve_damage(players, lives, now)
+
+                # Update the cameras (they jump straight to the players after a level change or restart)
+                cameras.follow(players, level_width, level_height, snap=initial_offset)
                 initial_offset = False
 
-            # Update camera
-            offset_x, offset_y = camera_follow(
-                players[0], offset_x, offset_y, level_width, level_height
-            )
-
-            # Check for player falling off the map, and if so decrease lives
-            for player in players:
-                if not player.on_ground and player.rect.top > (FALL_THRESHOLD):
-                    if pygame.time.get_ticks() - player.last_hit_time > 1000:
-                        jump_count = 0
-                        player.jump()
-                        lives -= 1
+                # Check for player falling off the map, and if so decrease lives
+                lives = check_falls(players, lives, now)
+                game_ticks += 1
+                # keep some of the recent states for rewinding
+                if game_ticks % REWIND_INTERVAL == 0:
+                    history.push(take_snapshot(current_level_data, players, hazards, lives, game_ticks, cameras))
+
+                # check for level completion
+                all_players_in_exit = players_at_exit(players, exit)
+
+                if all_players_in_exit:
+                    # switch to next lvl
+                    current_level_index += 1
+
+                    #exception to handle the end of the game
+                    try:
+                        #try to switch to the next lvl (already loaded in the background unless it isn't done yet)
+                        current_level, level_width, level_height = prefetcher.take(current_level_index, window)  # load next level
+                        current_level_data = (
+                            current_level,
+                            level_width,
+                            level_height,
+                            current_level_index,
+                        )  # update current lvl data
+                    except FileNotFoundError:
+                        #if no more lvls, u won
+                        game_state = GAME_WIN
+                        break
+
+                    background, bg_image = get_background(current_level.background)
+                    hazards.load(current_level.hazards)
+                    objects = [current_level.terrain, hazards]  # the pre-drawn level terrain and the hazards
+                    collision_grid = current_level.grid
+                    exit = current_level.exit #seperate exit
+
+                    for p in players:
+                        p.rect.x = current_level.player_start["x"]
+                        p.rect.y = current_level.player_start["y"]
+                        p.reset_previous_position()  # don't blend across the level change
+                    initial_offset = True
+                    # the level can be restarted from here
+                    checkpoint = take_snapshot(current_level_data, players, hazards, lives, game_ticks, cameras)
+                    # start reading the level after this one
+                    prefetcher.start(current_level_index + 1)
+
+                #check for lives
+                if lives <= 0:
+                    #if no more lives, u lost
+                    game_state = GAME_OVER
+
+            # if the game fell too far behind, drop the time instead of trying to catch up forever
+            if steps == MAX_CATCH_UP_STEPS:
+                accumulator = 0
+
+            if game_state != GAME:
+                # the run is over, save its input
+                if recording is not None:
+                    recording.save(record_path)
+                    recording = None
+                # a replay stops at the end of the run it recorded
+                if replay is not None:
+                    run = False
+
+        # how far we are between the last tick and the next one, used to blend positions when drawing
+        alpha = min(accumulator / TICK_TIME, 1)
 
         # draw game
-        menu_boxes = draw(window, background, bg_image, players, objects, exit, offset_x, offset_y, lives, game_state)
-
-        if game_state == GAME:
-            # check for level completion
-            all_players_in_exit = all(exit.rect.collidepoint(player.rect.center) for player in players)
-
-
-            if all_players_in_exit:
-                # switch to next lvl
-                current_level_index += 1
-                
-                #exception to handle the end of the game
-                try:
-                    #try to switch to the next lvl
-                    current_level, level_width, level_height = load_level(f"levels/level{current_level_index + 1}.json")  # load next level
-                    current_level_data = (
-                        current_level,
-                        level_width,
-                        level_height,
-                        current_level_index,
-                    )  # update current lvl data
-                except FileNotFoundError:
-                    #if no more lvls, u won
-                    game_state = GAME_WIN
-                    break
-
-                background, bg_image = get_background(current_level.background)
-                objects = current_level.blocks
-                exit = current_level.exit #seperate exit
-
-                for p in players:
-                    p.rect.x = current_level.player_start["x"]
-                    p.rect.y = current_level.player_start["y"]
-                initial_offset = True
+        with profiler.scope("draw"):
+            menu_boxes = draw(window, background, bg_image, players, objects, exit, 0, 0, lives, game_state, alpha, cameras)
 
-            #check for lives
-            if lives <= 0:
-                #if no more lives, u lost
-                game_state = GAME_OVER
-        elif game_state == GAME_OVER or game_state == GAME_WIN:
+        if game_state == GAME_OVER and checkpoint is not None:
+            keys = pygame.key.get_pressed()
+            if keys[pygame.K_r]:
+                # restart the level from its checkpoint right away, with full lives
+                restore_to = checkpoint
+                checkpoint.lives = num_players + 1
+                history.clear()
+        elif game_state == GAME_WIN:
             keys = pygame.key.get_pressed()
             if keys[pygame.K_r]:
                 # reset game
-                # load previous data
-                current_level, level_width, level_height, current_level_index = current_level_data
+                # load the first lvl again
+                current_level_index = 0
+                current_level, level_width, level_height = load_level(find_level(current_level_index))
+                current_level_data = (current_level, level_width, level_height, current_level_index)
                 background, bg_image = get_background(current_level.background)
 
                 for p in players:
@@ -758,12 +3650,19 @@ def main(window):
                 players = []
                 lives = 0
                 objects = []
-                offset_x = 0
-                offset_y = 0
+                collision_grid = SpatialGrid([])
                 exit = None # reset Exit
                 menu_boxes = []
                 initial_offset = True
 
+    # save the input of a run that was still going when the game was closed
+    if recording is not None:
+        recording.save(record_path)
+
+    # save the profile if it was recording
+    if profiler.enabled:
+        profiler.export(PROFILE_TRACE_PATH)
+
     # quit pygame
     pygame.quit()
     # quit program
@@ -771,4 +3670,68 @@ def main(window):
 
 # run main function
 if __name__ == "__main__":
-    main(window)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Glory to the Victors")
+    parser.add_argument("--headless-batch", action="store_true", help="replay input scripts on every level without a window and print the results")
+    parser.add_argument("--scripts", nargs="*", default=[], help="input script json files to replay (a list of ticks, each a list of action letters per player)")
+    parser.add_argument("--random-scripts", type=int, default=4, help="number of random scripts to replay when no script files are given")
+    parser.add_argument("--ticks", type=int, default=3600, help="length of the random scripts in ticks")
+    parser.add_argument("--players", type=int, default=2, help="number of players")
+    parser.add_argument("--processes", type=int, default=None, help="number of worker processes (defaults to one per cpu)")
+    parser.add_argument("--camera", choices=CAMERA_MODES, default=CAMERA_MODES[0], help="camera to start with: follow player one, group (zoom out to fit every player) or split screen (F2 switches)")
+    parser.add_argument("--low-res", action="store_true", help="draw the world at the pixel art's own size (half size) and scale it up to the window once a frame")
+    parser.add_argument("--smooth-scale", action="store_true", help="scale the game up to the window smoothly instead of repeating pixels")
+    parser.add_argument("--no-atlas-cache", action="store_true", help="pack the texture atlas at every start instead of saving it to assets/build")
+    parser.add_argument("--profile", action="store_true", help="start with the profiler and its overlay on (F3 toggles it, F4 saves a trace)")
+    parser.add_argument("--record", default=None, help="save the input of each run to this replay file (the last run is kept)")
+    parser.add_argument("--replay", default=None, help="play back a replay file recorded with --record")
+    parser.add_argument("--fast-forward", action="store_true", help="with --replay, run the replay without a window as fast as possible and print the result")
+    parser.add_argument("--benchmark", action="store_true", help="time loading, collisions, player updates and drawing on every level and on generated stress levels")
+    parser.add_argument("--benchmark-blocks", type=int, nargs="*", default=list(BENCHMARK_BLOCKS), help="block counts of the generated stress levels")
+    parser.add_argument("--benchmark-players", type=int, nargs="*", default=list(BENCHMARK_PLAYERS), help="player counts to benchmark every level with")
+    parser.add_argument("--benchmark-entities", type=int, nargs="*", default=list(BENCHMARK_ENTITIES), help="entity counts to benchmark the batched entity physics with (needs numpy)")
+    parser.add_argument("--benchmark-hazards", type=int, nargs="*", default=list(BENCHMARK_HAZARDS), help="hazard counts to benchmark the hazard pool with")
+    parser.add_argument("--benchmark-output", default=None, help="json file to save the benchmark results in (printed if not given)")
+    parser.add_argument("--benchmark-baseline", default=None, help="json file of earlier results to compare with, exits with an error if anything got slower")
+    parser.add_argument("--benchmark-tolerance", type=float, default=BENCHMARK_TOLERANCE, help="how much slower than the baseline a result can be (0.25 = 25%%)")
+    parser.add_argument("--compile-levels", nargs="*", default=None, metavar="PATH", help="compile levels into the binary level format, the given json files and Tiled maps or else levels/*.json, levels/*.tmx and Tiled/*.tmx")
+    parser.add_argument("--force", action="store_true", help="compile levels even if they haven't changed")
+    args = parser.parse_args()
+
+    if args.compile_levels is not None:
+        compiled = compile_levels(args.compile_levels or None, force=args.force)
+        print(f"compiled {len(compiled)} level(s) into {LEVEL_BUILD_DIR}")
+        for level_path in compiled:
+            print(f"  {level_path}")
+    elif args.benchmark:
+        results = run_benchmarks(args.benchmark_blocks, args.benchmark_players, entity_counts=args.benchmark_entities, hazard_counts=args.benchmark_hazards)
+        if args.benchmark_output:
+            with open(args.benchmark_output, "w") as f:
+                json.dump(results, f, indent=2)
+        else:
+            print(json.dumps(results, indent=2))
+        if args.benchmark_baseline:
+            with open(args.benchmark_baseline, "r") as f:
+                regressions = compare_benchmarks(results, json.load(f), args.benchmark_tolerance)
+            for regression in regressions:
+                print(f"slower: {regression}", file=sys.stderr)
+            if regressions:
+                sys.exit(1)
+    elif args.headless_batch:
+        scripts = []
+        for script_path in args.scripts:
+            with open(script_path, "r") as f:
+                scripts.append(json.load(f))
+        if not scripts:
+            scripts = [random_script(args.ticks, args.players, seed) for seed in range(args.random_scripts)]
+        for result in run_batch(scripts, num_players=args.players, processes=args.processes):
+            print(json.dumps(result))
+    elif args.replay and args.fast_forward:
+        init_headless()
+        print(json.dumps(fast_forward(read_replay(args.replay))))
+    else:
+        if args.profile:
+            profiler.toggle()
+        if args.low_res:
+            render_target.scale = LOW_RES_SCALE
+        render_target.smooth = args.smooth_scale
+        main(create_window(), args.record, read_replay(args.replay) if args.replay else None, args.camera, None if args.no_atlas_cache else ATLAS_BUILD_DIR)
\ No newline at end of file